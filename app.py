@@ -1,28 +1,87 @@
 """ Flask app for the cookbook """
 
+import bisect
+import functools
+import hashlib
 import json
+import math
+import mimetypes
 import os
+import re
 import subprocess
+import threading
+import time
 from dataclasses import dataclass
 from urllib.parse import urlparse
 from dotenv import load_dotenv
-from flask import Flask, render_template, request, Response
+from flask import (
+    abort,
+    before_render_template,
+    Blueprint,
+    current_app,
+    Flask,
+    g,
+    jsonify,
+    render_template,
+    request,
+    Response,
+    send_file,
+    template_rendered,
+)
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, text
 from sqlalchemy.exc import OperationalError
+from werkzeug.security import safe_join
+import assets
+import database
+import jobs
+import metrics
+from shared_state import SharedState
+from input_controller import SCROLL_DOWN, SCROLL_UP
+from input_controller import controller as input_controller
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATABASE_PATH = os.path.join(BASE_DIR, "recipes.db")
+STATIC_DIR = os.path.join(BASE_DIR, "static")
+IMAGES_DIR = os.path.join(STATIC_DIR, "images")
+TEMPLATES_DIR = os.path.join(BASE_DIR, "templates")
+GENERATED_DIR = os.path.join(TEMPLATES_DIR, "recipes")
+SEARCH_LIMIT = 50
+API_PAGE_SIZE = 24  # Recipes per /api/recipes page and on the first home page render
+API_MAX_LIMIT = 100
+PAGE_CACHE_SIZE = 512
+COMMAND_QUEUE_SIZE = 100
+COMMAND_KEEPALIVE = 15  # Seconds between SSE keepalive comments
+ASSET_MAX_AGE = 365 * 24 * 3600  # Fingerprinted assets never change under their name
+RESTART_DELAY = 2  # Seconds between a git pull finishing and the service restart
 
 load_dotenv()
 RECIPES_DIR = os.getenv("RECIPES_DIR")
-app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{DATABASE_PATH}"
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# Opt-in sampling profiler, writes folded stacks of slow requests to profiles/
+METRICS_PROFILE = os.getenv("METRICS_PROFILE", "0") == "1"
+METRICS_SLOW_SECONDS = float(os.getenv("METRICS_SLOW_SECONDS", "0.5"))
+PROFILE_DIR = os.path.join(BASE_DIR, "profiles")
+# Command queue and job status shared by the worker processes
+STATE_PATH = os.getenv("STATE_PATH", os.path.join(BASE_DIR, "state.db"))
 os.environ["BROWSER"] = "chromium-browser"
 os.environ["GIT_SSH"] = "/home/dietpi/gitssh.sh"
 os.environ["DISPLAY"] = ":0.0"
-db = SQLAlchemy(app)
-commands = []
+db = SQLAlchemy()
+bp = Blueprint("cookbook", __name__)
+
+
+def query_started(conn, *_):
+    """Remember when the query on this connection started"""
+    conn.info["query_start"] = time.perf_counter()
+
+
+def query_finished(conn, _cursor, statement, *_):
+    """Record the query time as a db span named by its statement type"""
+    start = conn.info.pop("query_start", None)
+    if start is not None:
+        metrics.span_seconds.observe(
+            time.perf_counter() - start, "db", statement.split(None, 1)[0].upper()
+        )
 
 
 @dataclass
@@ -35,122 +94,565 @@ class Recipes(db.Model):
     tags = db.Column(db.String(200))  # Comma-separated tags
 
 
+@dataclass
+class RecipeTags(db.Model):
+    """Database model for the normalized recipe tag index"""
+
+    __tablename__ = "recipe_tags"
+    recipe_id = db.Column(db.Integer, db.ForeignKey("recipes.id"), primary_key=True)
+    tag = db.Column(db.String(50), primary_key=True)
+
+
 @dataclass
 class Recipe:
     """Recipe dataclass"""
 
+    id: int
     name: str
     url: str
     image: str
-    number: int
+    number: int  # Display number, position in the name-sorted listing
+    slug: str  # File name without extension, as used by /view/<recipe>
+
+
+@dataclass(frozen=True)
+class CatalogSnapshot:
+    """Immutable view of the recipe catalog"""
+
+    recipes: list  # Recipe projections sorted by name
+    by_id: dict  # Recipes.id -> Recipe
+    position: dict  # Recipes.id -> index in recipes
+    keys: list  # (name, id) of every recipe in order, for keyset pagination
+    tags: list
+    generation: int  # Validates cached pages, None for a database without schema
+
+    def by_number(self, number):
+        """Return the recipe with the given display number, or None"""
+        if 1 <= number <= len(self.recipes):
+            return self.recipes[number - 1]
+        return None
+
+    @classmethod
+    def empty(cls):
+        """Return the snapshot of a database without recipes or schema"""
+        return cls(recipes=[], by_id={}, position={}, keys=[], tags=[], generation=None)
+
+    def lookup(self, ids):
+        """Return the recipes with the given ids, keeping the order of ids"""
+        return [self.by_id[recipe_id] for recipe_id in ids if recipe_id in self.by_id]
+
+    def page(self, after=None, limit=API_PAGE_SIZE, ids=None):
+        """
+        Return up to limit recipes after the (name, id) key, only those in ids
+        if given, and whether more recipes follow
+        """
+        start = bisect.bisect_right(self.keys, after) if after else 0
+        results = []
+        for recipe in self.recipes[start:]:
+            if ids is None or recipe.id in ids:
+                if len(results) == limit:
+                    return results, True
+                results.append(recipe)
+        return results, False
+
+    def select(self, ids):
+        """Return the recipes with the given ids, in catalog order"""
+        return [
+            self.by_id[recipe_id]
+            for recipe_id in sorted(
+                (recipe_id for recipe_id in ids if recipe_id in self.position),
+                key=self.position.get,
+            )
+        ]
+
+
+def display_name(file_path):
+    """Return the display name of a recipe file, e.g. apple_pie.html -> Apple Pie"""
+    return " ".join([word.capitalize() for word in file_path.split(".")[0].split("_")])
+
+
+def recipe_from_row(recipe, images, thumbnails, number):
+    """Build the Recipe projection of a database row"""
+    stem = recipe.file_path.split(".")[0]
+    if f"{stem}_thumb.webp" in thumbnails:
+        image = f"images/generated/{stem}_thumb.webp"
+    elif f"{stem}.jpg" in images:
+        image = f"images/{stem}.jpg"
+    else:
+        image = "images/default.svg"
+    return Recipe(
+        id=recipe.id,
+        name=display_name(recipe.file_path),
+        url=f"/recipes/{stem}",
+        image=image,
+        number=number,
+        slug=stem,
+    )
+
+
+def listdir(path):
+    """Return the set of file names in a directory, empty if it does not exist"""
+    try:
+        return set(os.listdir(path))
+    except OSError:
+        return set()
+
+
+class RecipeCatalog:
+    """Process-wide cache of the recipe listing, rebuilt when the recipes generation changes"""
+
+    def __init__(self, db_path, images_dir):
+        self.db_path = db_path
+        self.images_dir = images_dir
+        self._lock = threading.Lock()
+        self._key = None
+        self._snapshot = None
+        self._inode = None
+
+    def _current_key(self):
+        """
+        Return the recipes generation, bumped by generate_recipe.py in the same
+        transaction as every change to the recipes and after their images
+        """
+        try:
+            inode = os.stat(self.db_path).st_ino
+        except OSError:
+            inode = None
+        if inode != self._inode:
+            # make clean deleted the database, possibly from another worker:
+            # drop the connections to the old file
+            self._inode = inode
+            db.engine.dispose()
+        try:
+            row = db.session.execute(
+                text("SELECT value FROM metadata WHERE key = 'generation'")
+            ).first()
+        except OperationalError:
+            # No schema until make creates it again, e.g. after make clean
+            db.session.rollback()
+            return inode, None
+        return inode, row[0] if row else 0
+
+    def get(self):
+        """Return the current catalog snapshot, rebuilding it if it is stale"""
+        key = self._current_key()
+        with self._lock:
+            if self._snapshot is None or key != self._key:
+                metrics.cache_requests.inc("catalog", "miss")
+                with metrics.span_seconds.time("catalog", "rebuild"):
+                    if key[1] is None:
+                        self._snapshot = CatalogSnapshot.empty()
+                    else:
+                        self._snapshot = self._build(key[1])
+                self._key = key
+            else:
+                metrics.cache_requests.inc("catalog", "hit")
+            return self._snapshot
+
+    def _build(self, generation):
+        """Build the Recipe projections, image lookup and sorted order once"""
+        images = listdir(self.images_dir)
+        thumbnails = listdir(os.path.join(self.images_dir, "generated"))
+        # Display numbers follow the name order shown by /grid, ties broken by id
+        results = sorted(
+            Recipes.query.all(),
+            key=lambda recipe: (display_name(recipe.file_path), recipe.id),
+        )
+        by_id = {
+            recipe.id: recipe_from_row(recipe, images, thumbnails, number)
+            for number, recipe in enumerate(results, start=1)
+        }
+        ordered = [recipe.id for recipe in results]
+        recipes = [by_id[recipe_id] for recipe_id in ordered]
+        # all distinct tags in the database, capitalized and sorted
+        tags = [
+            tag.capitalize()
+            for (tag,) in db.session.query(RecipeTags.tag)
+            .distinct()
+            .order_by(RecipeTags.tag)
+        ]
+        return CatalogSnapshot(
+            recipes=recipes,
+            by_id=by_id,
+            position={recipe_id: i for i, recipe_id in enumerate(ordered)},
+            keys=[(recipe.name, recipe.id) for recipe in recipes],
+            tags=tags,
+            generation=generation,
+        )
+
 
+class PageCache:
+    """
+    Rendered HTML pages keyed by path and arguments. A page is valid for the
+    catalog generation it was rendered from; every rebuild of the recipes
+    bumps the generation, so no worker serves a page from before it.
+    """
+
+    def __init__(self, max_entries=PAGE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._pages = {}
+
+    def get(self, key, generation):
+        """Return the cached (body, etag) for the generation, or None"""
+        with self._lock:
+            page = self._pages.get(key)
+        if page and page[0] == generation:
+            return page[1], page[2]
+        return None
+
+    def put(self, key, generation, body):
+        """Store a rendered page and return its strong ETag"""
+        etag = hashlib.sha1(body).hexdigest()
+        with self._lock:
+            if key not in self._pages and len(self._pages) >= self.max_entries:
+                # Evict the oldest page
+                del self._pages[next(iter(self._pages))]
+            self._pages[key] = (generation, body, etag)
+        return etag
+
+    def __len__(self):
+        return len(self._pages)
+
+
+class CommandBus:
+    """Bounded command queue in the shared state, read through per-client cursors"""
+
+    def __init__(self, state, max_commands=COMMAND_QUEUE_SIZE):
+        self.state = state
+        self.max_commands = max_commands
+
+    @property
+    def cursor(self):
+        """Sequence number of the latest command"""
+        row = self.state.connection().execute("SELECT max(seq) FROM commands")
+        return row.fetchone()[0] or 0
+
+    def __len__(self):
+        row = self.state.connection().execute("SELECT count(*) FROM commands")
+        return row.fetchone()[0]
+
+    def publish(self, command):
+        """Append a command, drop the oldest ones and wake up waiting clients"""
+        conn = self.state.connection()
+        with conn:
+            seq = conn.execute(
+                "INSERT INTO commands (command) VALUES (?)", (json.dumps(command),)
+            ).lastrowid
+            conn.execute(
+                "DELETE FROM commands WHERE seq <= ?", (seq - self.max_commands,)
+            )
+        self.state.notify()
+        return seq
+
+    def wait(self, cursor, timeout):
+        """
+        Wait up to timeout for commands after cursor.
+        Returns the new cursor and the (sequence, command) pairs after the old one.
+        """
+        latest = self.cursor
+        if cursor > latest:
+            # Cursor from before the state was reset
+            cursor = latest
+        conn = self.state.connection()
+        rows = self.state.wait_for(
+            lambda: conn.execute(
+                "SELECT seq, command FROM commands WHERE seq > ? ORDER BY seq",
+                (cursor,),
+            ).fetchall(),
+            timeout,
+        )
+        events = [(seq, json.loads(command)) for seq, command in rows]
+        return (events[-1][0] if events else cursor), events
+
+
+catalog = RecipeCatalog(DATABASE_PATH, IMAGES_DIR)
+page_cache = PageCache()
+shared_state = SharedState(STATE_PATH)
+command_bus = CommandBus(shared_state)
+job_runner = jobs.JobRunner(shared_state)
+asset_manifest = assets.Manifest(STATIC_DIR, TEMPLATES_DIR)
+icons = assets.IconSprite(IMAGES_DIR)
+profiler = (
+    metrics.SlowRequestProfiler(PROFILE_DIR, METRICS_SLOW_SECONDS)
+    if METRICS_PROFILE
+    else None
+)
+metrics.registry.register(
+    metrics.Gauge(
+        "cookbook_command_queue_depth",
+        "Commands held by the command bus",
+        lambda: len(command_bus),
+    )
+)
+metrics.registry.register(
+    metrics.Gauge(
+        "cookbook_input_queue_depth",
+        "Key presses and scroll clicks waiting to be sent",
+        lambda: input_controller.pending,
+    )
+)
+metrics.registry.register(
+    metrics.Gauge(
+        "cookbook_page_cache_entries",
+        "Pages in the page cache",
+        lambda: len(page_cache),
+    )
+)
+
+
+@bp.before_app_request
+def start_timer():
+    """Note the request start, and start sampling it when profiling"""
+    g.request_start = time.perf_counter()
+    if profiler:
+        profiler.start_request()
+
+
+@bp.after_app_request
+def record_request(response):
+    """Record the request latency by route, method and status"""
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.request_seconds.observe(
+        time.perf_counter() - g.request_start,
+        route,
+        request.method,
+        response.status_code,
+    )
+    return response
 
-@app.route("/")
+
+@bp.teardown_app_request
+def finish_profile(_exc):
+    """Stop sampling the request, keeping its stacks if it was slow"""
+    if profiler and "request_start" in g:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        profiler.finish_request(
+            f"{request.method} {route}", time.perf_counter() - g.request_start
+        )
+
+
+@bp.app_url_defaults
+def fingerprint_static(endpoint, values):
+    """Point url_for('static') at the built asset when assets.py built one"""
+    if endpoint == "static":
+        built = asset_manifest.get(values.get("filename"))
+        if built:
+            values["filename"] = built
+
+
+def render_started(_sender, **_):
+    """Push the template render start time"""
+    g.setdefault("render_starts", []).append(time.perf_counter())
+
+
+def render_finished(_sender, template, **_):
+    """Record the template render time as a render span"""
+    start = g.render_starts.pop()
+    metrics.span_seconds.observe(time.perf_counter() - start, "render", template.name)
+
+
+@bp.route("/metrics")
+def metrics_endpoint():
+    """Expose the metrics in the Prometheus text format"""
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+def cached_page(view):
+    """Serve a view from the page cache with an ETag, answering conditional GETs with 304"""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.full_path
+        try:
+            generation = catalog.get().generation
+        except OperationalError:
+            return view(*args, **kwargs)
+        page = page_cache.get(key, generation)
+        if page:
+            metrics.cache_requests.inc("page", "hit")
+            body, etag = page
+        else:
+            metrics.cache_requests.inc("page", "miss")
+            body = view(*args, **kwargs)
+            if isinstance(body, str):
+                body = body.encode("utf-8")
+            elif not isinstance(body, bytes):
+                return body  # Errors and other responses are not cached
+            etag = page_cache.put(key, generation, body)
+        response = Response(body, mimetype="text/html")
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+        return response.make_conditional(request)
+
+    return wrapper
+
+
+@bp.route("/")
+@cached_page
 def home():
     """Display the home page"""
     recipe_files = []
     tags = []
+    more = False
     try:
-        results = Recipes.query.all()
-        recipe_files = [
-            Recipe(
-                " ".join(
-                    [
-                        word.capitalize()
-                        for word in recipe.file_path.split(".")[0].split("_")
-                    ]
-                ),
-                f"/recipes/{recipe.file_path.split('.')[0]}",
-                (
-                    f"images/{recipe.file_path.split('.')[0]}.jpg"
-                    if os.path.isfile(
-                        f"static/images/{recipe.file_path.split('.')[0]}.jpg"
-                    )
-                    else "images/default.svg"
-                ),
-                recipe.id,
-            )
-            for recipe in results
-        ]
-        # all non-empty tags in the database, split by comma, capitalized, sorted and unique
-        tags = sorted(
-            {
-                tag.capitalize()
-                for recipe in results
-                for tag in recipe.tags.split(",")
-                if tag
-            }
-        )
+        snapshot = catalog.get()
+        # The first page only, the rest is loaded from /api/recipes on scroll
+        recipe_files, more = snapshot.page()
+        tags = snapshot.tags
     except OperationalError as e:
-        app.logger.error("Database error: %s", e)
+        current_app.logger.error("Database error: %s", e)
 
-    return render_template("index.html", recipes=recipe_files, tags=tags)
+    return render_template(
+        "index.html",
+        recipes=recipe_files,
+        tags=tags,
+        next=page_cursor(recipe_files[-1].id, recipe_files[-1].name) if more else "",
+    )
 
 
-@app.route("/find", methods=["POST"])
+@bp.route("/find", methods=["POST"])
 def find():
     """Search for recipes by name or tag"""
     search = request.form.get("search", "")
     tag = request.args.get("tag")
+    snapshot = catalog.get()
 
-    if tag:
-        results = Recipes.query.filter(Recipes.tags.contains(tag)).all()
+    if not snapshot.recipes:
+        results = []  # Nothing to search, the tables may not even exist
+    elif tag:
+        results = snapshot.select(tag_recipe_ids(tag))
     elif search:
-        results = Recipes.query.filter(
-            (Recipes.name.contains(search)) | (Recipes.tags.contains(search))
-        ).all()
+        results = snapshot.lookup(
+            [recipe_id for recipe_id, _ in search_recipes(search)]
+        )
     else:
-        results = Recipes.query.all()
-
-    results = [
-        Recipe(
-            name=" ".join(
-                [
-                    word.capitalize()
-                    for word in recipe.file_path.split(".")[0].split("_")
-                ]
-            ),
-            url=f"/recipes/{recipe.file_path.split('.')[0]}",
-            image=(
-                f"images/{recipe.file_path.split('.')[0]}.jpg"
-                if os.path.isfile(f"static/images/{recipe.file_path.split('.')[0]}.jpg")
-                else "images/default.svg"
-            ),
-            number=recipe.id,
+        results = snapshot.recipes
+
+    return render_template("search.html", recipes=results)
+
+
+@bp.route("/api/recipes")
+def api_recipes():
+    """
+    List recipes as JSON a page at a time, in (name, id) order, or best
+    match first when searching, with their cards rendered from search.html.
+    Filters: q (search text) and tag. Pass the returned next cursor as after.
+    """
+    tag = request.args.get("tag", "").strip()
+    search = request.args.get("q", "").strip()
+    try:
+        limit = min(
+            max(int(request.args.get("limit", API_PAGE_SIZE)), 1), API_MAX_LIMIT
         )
-        for recipe in results
-    ]
+        after = parse_cursor(request.args.get("after"), ranked=bool(search))
+    except ValueError:
+        return error("Invalid limit or cursor")
+    snapshot = catalog.get()
+
+    if not snapshot.recipes:
+        results, cursor = [], None  # The tables may not even exist
+    elif search:
+        # Keyset over (rank, id), the query stops after this page
+        hits = search_recipes(search, limit + 1, after=after, tag=tag or None)
+        more = len(hits) > limit
+        hits = hits[:limit]
+        results = snapshot.lookup([recipe_id for recipe_id, _ in hits])
+        cursor = page_cursor(*hits[-1]) if more else None
+    else:
+        ids = set(tag_recipe_ids(tag)) if tag else None
+        results, more = snapshot.page(after, limit, ids)
+        cursor = page_cursor(results[-1].id, results[-1].name) if more else None
+    return jsonify(
+        # The same cards as the server-rendered listing
+        html=render_template("search.html", recipes=results),
+        next=cursor,
+    )
 
-    # sort results by name
-    results = sorted(results, key=lambda x: x.name)
 
-    return render_template("search.html", recipes=results)
+def page_cursor(recipe_id, key):
+    """Return the keyset cursor 'id:key' of a page's last recipe"""
+    return f"{recipe_id}:{key}"
+
+
+def parse_cursor(cursor, ranked=False):
+    """
+    Return the (key, id) of a cursor, or None; ValueError if malformed.
+    The key is the search rank if ranked, the recipe name otherwise.
+    """
+    if not cursor:
+        return None
+    recipe_id, separator, key = cursor.partition(":")
+    if not separator:
+        raise ValueError(f"Invalid cursor {cursor}")
+    return (float(key) if ranked else key), int(recipe_id)
+
+
+def tag_recipe_ids(tag):
+    """Return the ids of the recipes with a tag"""
+    query = db.session.query(RecipeTags.recipe_id).filter(RecipeTags.tag == tag.lower())
+    return [recipe_id for (recipe_id,) in query]
+
+
+def search_recipes(search, limit=SEARCH_LIMIT, after=None, tag=None):
+    """
+    Return (recipe id, rank) pairs matching the search text, best match
+    first, after the (rank, id) key if given and only recipes with tag
+    """
+    # Prefix-match every word, quoted so user input cannot inject FTS5 syntax
+    words = re.findall(r"\w+", search)
+    if not words:
+        return []
+    match = " ".join(f'"{word}"*' for word in words)
+    rank, after_id = after if after else (float("-inf"), 0)
+    params = {"match": match, "limit": limit, "rank": rank, "id": after_id}
+    tag_filter = ""
+    if tag:
+        tag_filter = "AND rowid IN (SELECT recipe_id FROM recipe_tags WHERE tag = :tag)"
+        params["tag"] = tag.lower()
+    try:
+        rows = db.session.execute(
+            text(
+                f"""
+            SELECT id, rank FROM (
+                SELECT rowid AS id, bm25(recipes_fts, 10.0, 5.0, 2.0, 1.0) AS rank
+                FROM recipes_fts
+                WHERE recipes_fts MATCH :match {tag_filter}
+            )
+            WHERE rank > :rank OR (rank = :rank AND id > :id)
+            ORDER BY rank, id
+            LIMIT :limit
+            """
+            ),
+            params,
+        ).all()
+    except OperationalError as e:
+        # Database generated before the search index existed, unranked
+        current_app.logger.error("Search index error: %s", e)
+        db.session.rollback()
+        query = db.session.query(Recipes.id).filter(
+            (Recipes.name.contains(search)) | (Recipes.tags.contains(search)),
+            Recipes.id > after_id,
+        )
+        if tag:
+            query = query.filter(
+                Recipes.id.in_(
+                    db.session.query(RecipeTags.recipe_id).filter(
+                        RecipeTags.tag == tag.lower()
+                    )
+                )
+            )
+        rows = [
+            (recipe_id, 0.0) for (recipe_id,) in query.order_by(Recipes.id).limit(limit)
+        ]
+    return [(recipe_id, rank) for recipe_id, rank in rows]
 
 
-@app.route("/grid")
+@bp.route("/grid")
+@cached_page
 def grid():
     """List all recipes"""
-    recipes = Recipes.query.all()
-    recipes = [
-        Recipe(
-            name=" ".join(
-                [
-                    word.capitalize()
-                    for word in recipe.file_path.split(".")[0].split("_")
-                ]
-            ),
-            url=f"/recipes/{recipe.file_path.split('.')[0]}",
-            image=(
-                f"images/{recipe.file_path.split('.')[0]}.jpg"
-                if os.path.isfile(f"static/images/{recipe.file_path.split('.')[0]}.jpg")
-                else "images/default.svg"
-            ),
-            number=recipe.id,
-        )
-        for recipe in recipes
-    ]
-    recipes = sorted(recipes, key=lambda x: x.name)
-    return render_template("list.html", recipes=recipes)
+    return render_template("list.html", recipes=catalog.get().recipes)
 
 
 def is_safe_url(url):
@@ -169,143 +671,293 @@ def xdg_open(url):
     if not url or not is_safe_url(url):
         return error("Invalid or unsafe URL")
     try:
-        subprocess.run(["xdg-open", url], check=True)
+        run(["xdg-open", url])
     except subprocess.CalledProcessError as e:
         return error(e)
     return "", 200  # Return empty response
 
 
-@app.route("/open_link")
+@bp.route("/open_link")
 def open_link():
     """Open a link in the browser."""
     url = request.args.get("url")
     return xdg_open(url)
 
 
-@app.route("/git_pull")
+@bp.route("/git_pull")
 def git_pull():
     """Pull the latest changes from the Git repository and restart the Flask app"""
-    try:
-        subprocess.run(["git", "pull"], check=True)
-    except subprocess.CalledProcessError as e:
-        return error(e)
-    try:
-        subprocess.run(["sudo", "systemctl", "restart", "flaskapp.service"], check=True)
-    except subprocess.CalledProcessError as e:
-        return error(e)
-    return "", 200  # Return empty response
+    # Schedule the restart rather than running it: restarting from the job
+    # would kill this process before it records the job's status
+    return start_job(
+        "git_pull",
+        [
+            ["git", "pull"],
+            [
+                "sudo",
+                "systemd-run",
+                f"--on-active={RESTART_DELAY}",
+                "systemctl",
+                "restart",
+                "flaskapp.service",
+            ],
+        ],
+    )
 
 
-@app.route("/make_recipes")
+@bp.route("/make_recipes")
 def make_recipes():
     """Generate the HTML files for the recipes"""
-    try:
-        subprocess.run(["make", f"RECIPES_DIR={RECIPES_DIR}"], check=True)
-    except subprocess.CalledProcessError as e:
-        return error(e)
-    return "", 200
+    return start_job("make_recipes", [["make", f"RECIPES_DIR={RECIPES_DIR}"]])
 
 
-@app.route("/reset")
+@bp.route("/reset")
 def reset():
     """Clean the generated HTML files"""
-    try:
-        subprocess.run(["make", "clean"], check=True)
-    except subprocess.CalledProcessError as e:
-        return error(e)
-    return "", 200
+    return start_job("reset", [["make", "clean"]])
+
+
+def start_job(name, commands):
+    """Start a background job, 202 with its state or 409 if a job is running"""
+    # The catalog and the page cache of every worker follow the recipes
+    # generation, bumped by make, and the database file, deleted by make clean
+    job, started = job_runner.start(name, commands)
+    if not started:
+        # job is None when the running job finished in the meantime
+        message = f"{job['name'] if job else 'A job'} is still running"
+        current_app.logger.error("Error: %s", message)
+        return jsonify(error=message, job=job), 409
+    return jsonify(job), 202, {"Location": f"/jobs/{job['id']}"}
+
+
+@bp.route("/jobs")
+def list_jobs():
+    """List the recent jobs, newest first"""
+    return jsonify(jobs=job_runner.list())
+
+
+@bp.route("/jobs/<int:job_id>")
+def job_status(job_id):
+    """Return the status and output of a job"""
+    job = job_runner.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job)
+
+
+@bp.route("/jobs/<int:job_id>/stream")
+def stream_job(job_id):
+    """Stream a job's output lines and status changes as Server-Sent Events"""
+    job = job_runner.get(job_id)
+    if job is None:
+        abort(404)
+
+    def events(job):
+        sent = max(job["lines"] - len(job["output"]), 0)
+        status = None
+        while True:
+            new = job["lines"] - sent
+            for line in job["output"][-new:] if new > 0 else []:
+                yield f"event: output\ndata: {json.dumps(line)}\n\n"
+            sent = job["lines"]
+            if job["status"] != status:
+                status = job["status"]
+                state = {key: value for key, value in job.items() if key != "output"}
+                yield f"event: status\ndata: {json.dumps(state)}\n\n"
+            elif not new:
+                yield ": keepalive\n\n"
+            if status != jobs.RUNNING:
+                return
+            job = job_runner.wait(job_id, job["version"], COMMAND_KEEPALIVE)
+
+    return Response(
+        events(job),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
-@app.route("/recipes/<recipe>")
+@bp.route("/recipes/<recipe>")
 def view_recipe(recipe):
     """View a specific recipe"""
     if recipe.isdigit():
-        # Get the filename number from sorted list of recipes by db name
-        recipe = sorted([recipe.file_path for recipe in Recipes.query.all()])[
-            int(recipe) - 1
-        ].split(".")[0]
+        # Resolve the display number shown on the /grid cards
+        match = catalog.get().by_number(int(recipe))
+        if match is None:
+            return error(f"No recipe number {recipe}")
+        recipe = match.slug
     return xdg_open(f"http://localhost:8001/view/{recipe}")
 
 
-@app.route("/view/<recipe>")
+@bp.route("/view/<recipe>")
+@cached_page
 def view(recipe):
-    """View a specific recipe"""
-    return render_template(f"recipes/{recipe}.html")
-
-
-@app.route("/page_up")
+    """View a specific recipe, prerendered to static HTML by generate_recipe.py"""
+    path = safe_join(GENERATED_DIR, f"{recipe}.html")
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@bp.route("/static/dist/<path:filename>")
+def asset(filename):
+    """
+    Serve a built asset, precompressed when the client accepts it. Its name
+    changes with its content, so browsers may keep it for good.
+    """
+    path = safe_join(os.path.join(STATIC_DIR, assets.DIST), filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    encoding = None
+    for name, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if request.accept_encodings[name] and os.path.isfile(path + suffix):
+            path, encoding = path + suffix, name
+            break
+    response = send_file(path, mimetype=mimetype, max_age=ASSET_MAX_AGE)
+    response.content_encoding = encoding
+    response.vary.add("Accept-Encoding")
+    response.cache_control.immutable = True
+    return response
+
+
+@bp.route("/page_up")
 def page_up():
     """Scroll up the browser window"""
-    xdotool("key Page_Up")
+    input_controller.key("Page_Up")
     return "", 200  # Return empty response
 
 
-@app.route("/page_down")
+@bp.route("/page_down")
 def page_down():
     """Scroll down the browser window"""
-    xdotool("key Page_Down")
+    input_controller.key("Page_Down")
     return "", 200  # Return empty response
 
 
-@app.route("/scroll_up")
+@bp.route("/scroll_up")
 def scroll_up():
     """Scroll up the browser window"""
-    xdotool("mousemove 100 100 click 4")
+    input_controller.scroll(SCROLL_UP)
     return "", 200  # Return empty response
 
 
-@app.route("/scroll_down")
+@bp.route("/scroll_down")
 def scroll_down():
     """Scroll down the browser window"""
-    xdotool("mousemove 100 100 click 5")
+    input_controller.scroll(SCROLL_DOWN)
     return "", 200  # Return empty response
 
 
-@app.route("/zoom_in")
+@bp.route("/zoom_in")
 def zoom_in():
     """Zoom in the browser window"""
-    xdotool("key ctrl+plus")
+    input_controller.key("ctrl+plus")
     return "", 200  # Return empty response
 
 
-@app.route("/zoom_out")
+@bp.route("/zoom_out")
 def zoom_out():
     """Zoom out the browser window"""
-    xdotool("key ctrl+minus")
+    input_controller.key("ctrl+minus")
     return "", 200  # Return empty response
 
 
-@app.route("/commands", methods=["POST"])
+@bp.route("/commands", methods=["POST"])
 def add_command():
     """Add a command to the queue"""
     data = request.json
-    commands.append(data)
+    command_bus.publish(data)
     return Response(json.dumps({"status": "success"}), content_type="application/json")
 
 
-@app.route("/commands", methods=["GET"])
+@bp.route("/commands", methods=["GET"])
 def get_commands():
-    """Get the next command from the queue"""
-    if commands:
-        return Response(json.dumps(commands.pop(0)), content_type="application/json")
-    return Response(json.dumps({}), content_type="application/json")
+    """Long-poll for the commands published after the client's cursor"""
+    cursor = request.args.get("cursor", type=int)
+    if cursor is None:
+        # New client, start from the current end of the queue
+        cursor, commands = command_bus.cursor, []
+    else:
+        timeout = request.args.get("timeout", 25, type=float)
+        if not math.isfinite(timeout):
+            # A NaN timeout would never run out
+            return error("Invalid timeout")
+        cursor, events = command_bus.wait(cursor, max(0, min(timeout, 60)))
+        commands = [command for _, command in events]
+    return Response(
+        json.dumps({"cursor": cursor, "commands": commands}),
+        content_type="application/json",
+    )
 
 
-def xdotool(cmd):
-    """Run the xdotool command with the correct DISPLAY environment variable"""
-    try:
-        subprocess.run(["xdotool", *cmd.split()], check=True)
-    except subprocess.CalledProcessError as e:
-        return error(e)
-    return "", 200  # Return empty response
+@bp.route("/commands/stream")
+def stream_commands():
+    """Stream commands to the client as Server-Sent Events"""
+    cursor = request.headers.get("Last-Event-ID", type=int)
+    if cursor is None:
+        cursor = command_bus.cursor
+
+    def events(cursor):
+        yield "retry: 1000\n\n"
+        while True:
+            cursor, new = command_bus.wait(cursor, COMMAND_KEEPALIVE)
+            if not new:
+                yield ": keepalive\n\n"
+            for seq, command in new:
+                yield f"id: {seq}\ndata: {json.dumps(command)}\n\n"
+
+    return Response(
+        events(cursor),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def run(args):
+    """Run a command, timed as a subprocess span; raises CalledProcessError"""
+    with metrics.span_seconds.time("subprocess", args[0]):
+        subprocess.run(args, check=True)
 
 
 def error(e):
     """Return an error message"""
-    app.logger.error("Error: %s", e)  # Log the error message
+    current_app.logger.error("Error: %s", e)  # Log the error message
     return str(e), 400  # Return error message
 
 
+def create_app():
+    """
+    Create the Flask app. In production run several gunicorn workers with
+    'app:create_app()', they share the recipes database and the state file.
+    """
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{DATABASE_PATH}"
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "connect_args": {"timeout": database.BUSY_TIMEOUT}
+    }
+    db.init_app(app)
+
+    # Create missing tables and migrate databases built by older versions
+    database.setup_database(DATABASE_PATH)
+    database.close(DATABASE_PATH)
+    with app.app_context():
+        # Same WAL mode and pragmas as the builder, so reads continue during a rebuild
+        event.listen(db.engine, "connect", lambda conn, _: database.configure(conn))
+        event.listen(db.engine, "before_cursor_execute", query_started)
+        event.listen(db.engine, "after_cursor_execute", query_finished)
+
+    before_render_template.connect(render_started, app)
+    template_rendered.connect(render_finished, app)
+    app.add_template_global(icons.icon, "icon")
+    app.add_template_global(icons.markup, "icon_sprite")
+    app.register_blueprint(bp)
+    return app
+
+
 if __name__ == "__main__":
     os.chdir(BASE_DIR)
-    app.run(host="0.0.0.0", port=8001)
+    # Development server, see service/flaskapp.service for production
+    create_app().run(host="0.0.0.0", port=8001, threaded=True)
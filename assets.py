@@ -0,0 +1,406 @@
+""" Static asset build: purged Bulma, hashed precompressed files and an SVG sprite. """
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+
+from markupsafe import Markup, escape
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(BASE_DIR, "static")
+TEMPLATES_DIR = os.path.join(BASE_DIR, "templates")
+DIST = "dist"  # Build output, relative to the static directory
+GENERATED_DIR = (
+    "recipes"  # Prerendered recipe pages, relative to the templates directory
+)
+MANIFEST_FILE = "manifest.json"
+# Files served fingerprinted, relative to the static directory. Recipe images
+# change with every build and keep their plain URLs.
+ASSETS = (
+    "bulma.min.css",
+    "styles.css",
+    "styles_home.css",
+    "script.js",
+    "timer.js",
+    "images/logo.webp",
+)
+PURGED = ("bulma.min.css",)  # Reduced to the classes the templates and scripts use
+COMPRESSED = (".css", ".js", ".svg")  # Images are already compressed
+HASH_LENGTH = 10
+SPRITE_MAX_BYTES = 2048  # Larger SVGs stay separate images
+
+COMMENT = re.compile(r"/\*.*?\*/", re.S)
+LICENSE_COMMENT = re.compile(r"/\*!.*?\*/", re.S)
+# Rules holding rules, purged recursively. Other at-rules (@keyframes,
+# @font-face) are kept whole.
+NESTED_AT_RULES = ("@media", "@supports", "@layer", "@container")
+CLASS_NAME = re.compile(r"\.((?:[\w-]|\\.)+)")
+# Arguments of :not(), :is(), :where() and :has() and attribute selectors,
+# classes in them do not decide whether a selector can match
+SELECTOR_ARGUMENTS = re.compile(r"\([^()]*\)|\[[^\[\]]*\]")
+CLASS_ATTRIBUTE = re.compile(r"""class=["']([^"']*)["']""")
+CLASS_LIST_CALL = re.compile(r"classList\.\w+\(([^)]*)\)")
+CLASS_WORD = re.compile(r"[A-Za-z_][\w-]*")
+# Custom property declarations and references, for dropping unused variables
+CUSTOM_PROPERTY = re.compile(r"(?<=[{;])(--[\w-]+):[^;{}]*;?")
+VARIABLE_REFERENCE = re.compile(r"var\(\s*(--[\w-]+)")
+DIST_LINK = re.compile(rf"/{DIST}/([\w./-]+)")
+SVG_ROOT = re.compile(r"<svg\b([^>]*)>(.*)</svg>", re.S)
+SVG_ATTRIBUTE = re.compile(r'([\w:-]+)="([^"]*)"')
+
+
+def css_rules(css):
+    """
+    Split a stylesheet into its top-level (prelude, block) pairs, block is
+    None for statements such as @charset. Comments are dropped.
+    """
+    rules = []
+    start, depth, i = 0, 0, 0
+    prelude_end = 0
+    while i < len(css):
+        char = css[i]
+        if char in "\"'":
+            # Skip strings, they may hold braces
+            i += 1
+            while i < len(css) and css[i] != char:
+                i += 2 if css[i] == "\\" else 1
+        elif css.startswith("/*", i):
+            end = css.find("*/", i + 2)
+            i = len(css) if end < 0 else end + 1
+        elif char == "{":
+            if depth == 0:
+                prelude_end = i
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                prelude = COMMENT.sub("", css[start:prelude_end]).strip()
+                rules.append((prelude, css[prelude_end + 1 : i]))
+                start = i + 1
+        elif char == ";" and depth == 0:
+            rules.append((COMMENT.sub("", css[start:i]).strip(), None))
+            start = i + 1
+        i += 1
+    return rules
+
+
+def split_selectors(prelude):
+    """Split a selector list at its top-level commas"""
+    selectors, depth, start = [], 0, 0
+    for i, char in enumerate(prelude):
+        if char in "([":
+            depth += 1
+        elif char in ")]":
+            depth -= 1
+        elif char == "," and depth == 0:
+            selectors.append(prelude[start:i].strip())
+            start = i + 1
+    selectors.append(prelude[start:].strip())
+    return selectors
+
+
+def selector_used(selector, used):
+    """Return whether every class a selector requires is in used, None keeps all"""
+    if used is None:
+        return True
+    bare, previous = selector, None
+    while bare != previous:
+        previous, bare = bare, SELECTOR_ARGUMENTS.sub("", bare)
+    return all(
+        re.sub(r"\\(.)", r"\1", name) in used for name in CLASS_NAME.findall(bare)
+    )
+
+
+def purge_css(css, used):
+    """Drop the style rules whose selectors need a class outside used"""
+    output = []
+    for prelude, block in css_rules(css):
+        if block is None:
+            output.append(f"{prelude};")
+        elif prelude.startswith(NESTED_AT_RULES):
+            inner = purge_css(block, used)
+            if inner:
+                output.append(f"{prelude}{{{inner}}}")
+        elif prelude.startswith("@"):
+            output.append(f"{prelude}{{{block}}}")
+        elif block.strip():
+            selectors = [s for s in split_selectors(prelude) if selector_used(s, used)]
+            if selectors:
+                output.append(f"{','.join(selectors)}{{{block}}}")
+    return "".join(output)
+
+
+def purge_variables(css):
+    """
+    Drop the declarations of custom properties no var() refers to, repeated
+    since variables refer to each other, then the rules left empty.
+    """
+    previous = None
+    while css != previous:
+        referenced = set(VARIABLE_REFERENCE.findall(css))
+        previous, css = css, CUSTOM_PROPERTY.sub(
+            lambda match: match.group(0) if match.group(1) in referenced else "", css
+        )
+    return purge_css(css, None)
+
+
+def used_classes(templates_dir, static_dir):
+    """
+    Return the class names set in the templates and by the scripts, including
+    the words of Jinja expressions in class attributes, to stay on the safe side.
+    """
+    used = set()
+    for name in sorted(os.listdir(templates_dir)):
+        if name.endswith(".html"):
+            with open(os.path.join(templates_dir, name), "r", encoding="utf-8") as f:
+                for value in CLASS_ATTRIBUTE.findall(f.read()):
+                    used.update(CLASS_WORD.findall(value))
+    for name in sorted(os.listdir(static_dir)):
+        if name.endswith(".js"):
+            with open(os.path.join(static_dir, name), "r", encoding="utf-8") as f:
+                for arguments in CLASS_LIST_CALL.findall(f.read()):
+                    used.update(re.findall(r"""["']([\w-]+)["']""", arguments))
+    return used
+
+
+def linked_files(templates_dir):
+    """
+    Return the built files, relative to the dist directory, linked by the
+    prerendered recipe pages. Only make renders them again, so they may
+    link files of any earlier build.
+    """
+    linked = set()
+    pages_dir = os.path.join(templates_dir, GENERATED_DIR)
+    if not os.path.isdir(pages_dir):
+        return linked
+    for name in sorted(os.listdir(pages_dir)):
+        if name.endswith(".html"):
+            with open(os.path.join(pages_dir, name), "r", encoding="utf-8") as f:
+                linked.update(DIST_LINK.findall(f.read()))
+    return linked
+
+
+def input_digest(static_dir, templates_dir):
+    """
+    Return a SHA-256 digest of everything a build reads: the assets, the
+    templates and scripts the purge scans, and this module.
+    """
+    paths = [(name, os.path.join(static_dir, name)) for name in ASSETS]
+    paths += [
+        (name, os.path.join(directory, name))
+        for directory, suffix in ((templates_dir, ".html"), (static_dir, ".js"))
+        for name in sorted(os.listdir(directory))
+        if name.endswith(suffix)
+    ]
+    paths.append((os.path.basename(__file__), os.path.abspath(__file__)))
+    digest = hashlib.sha256()
+    for name, path in paths:
+        with open(path, "rb") as f:
+            digest.update(name.encode("utf-8") + b"\0" + f.read())
+    return digest.hexdigest()
+
+
+def fingerprint(filename, data):
+    """Return the name with a hash of the content, script.js -> script.<hash>.js"""
+    stem, ext = os.path.splitext(filename)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:HASH_LENGTH]}{ext}"
+
+
+def compressed_variants(data):
+    """Yield (suffix, data) for the gzip and, when available, brotli encodings"""
+    yield ".gz", gzip.compress(data, compresslevel=9, mtime=0)
+    if brotli is not None:
+        yield ".br", brotli.compress(data, quality=11)
+
+
+def write_file(path, data):
+    """Write a file atomically, readers see the old or the new content"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def read_manifest(static_dir):
+    """Return the last build's manifest, or None"""
+    try:
+        with open(
+            os.path.join(static_dir, DIST, MANIFEST_FILE), "r", encoding="utf-8"
+        ) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def build(static_dir=STATIC_DIR, templates_dir=TEMPLATES_DIR):
+    """
+    Write the fingerprinted, purged and precompressed assets to static/dist
+    and the manifest mapping their names to the built files.
+    Returns the manifest.
+    """
+    used = used_classes(templates_dir, static_dir)
+    files = {}
+    for name in ASSETS:
+        with open(os.path.join(static_dir, name), "rb") as f:
+            data = f.read()
+        if name in PURGED:
+            css = data.decode("utf-8")
+            purged = purge_variables(purge_css(css, used))
+            # License comments go after @charset, which has to come first
+            charset = re.match(r"@charset[^;]*;", purged)
+            head = charset.group(0) if charset else ""
+            licenses = "".join(LICENSE_COMMENT.findall(css))
+            data = (head + licenses + purged[len(head) :]).encode("utf-8")
+        built = f"{DIST}/{fingerprint(name, data)}"
+        path = os.path.join(static_dir, built)
+        if not os.path.exists(path):
+            write_file(path, data)
+            if name.endswith(COMPRESSED):
+                for suffix, variant in compressed_variants(data):
+                    if len(variant) < len(data):
+                        write_file(path + suffix, variant)
+        files[name] = built
+        print(f"{name} -> {built} ({len(data)} bytes)")
+
+    previous = read_manifest(static_dir) or {}
+    manifest = {"inputs": input_digest(static_dir, templates_dir), "files": files}
+    write_file(
+        os.path.join(static_dir, DIST, MANIFEST_FILE),
+        json.dumps(manifest, indent=2).encode("utf-8"),
+    )
+    # Pages rendered before this build may still link the previous files,
+    # and the recipe pages those of the build they were rendered with
+    keep = {MANIFEST_FILE}
+    names = [
+        os.path.relpath(built, DIST)
+        for built in list(files.values()) + list(previous.get("files", {}).values())
+    ]
+    for name in names + sorted(linked_files(templates_dir)):
+        keep.update((name, f"{name}.gz", f"{name}.br"))
+    dist_dir = os.path.join(static_dir, DIST)
+    for directory, _, names in os.walk(dist_dir):
+        for name in names:
+            path = os.path.join(directory, name)
+            if os.path.relpath(path, dist_dir) not in keep:
+                os.remove(path)
+    return manifest
+
+
+class Manifest:
+    """
+    Built asset names for url_for, reloaded when the manifest file changes.
+    A manifest built from other sources than the current ones is ignored, so
+    a stale build falls back to the plain files instead of outdated ones.
+    """
+
+    def __init__(self, static_dir=STATIC_DIR, templates_dir=TEMPLATES_DIR):
+        self.static_dir = static_dir
+        self.templates_dir = templates_dir
+        self._lock = threading.Lock()
+        self._stat = None
+        self._files = {}
+
+    def files(self):
+        """Return {static file name: built file name} of the current build"""
+        path = os.path.join(self.static_dir, DIST, MANIFEST_FILE)
+        try:
+            stat = os.stat(path)
+            stat = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            stat = None
+        with self._lock:
+            if stat != self._stat:
+                self._stat = stat
+                self._files = {}
+                manifest = read_manifest(self.static_dir)
+                if manifest and manifest.get("inputs") == input_digest(
+                    self.static_dir, self.templates_dir
+                ):
+                    self._files = manifest["files"]
+            return self._files
+
+    def get(self, filename):
+        """Return the built file name for a static file, or None"""
+        return self.files().get(filename)
+
+
+class IconSprite:
+    """
+    The small SVG icons of a directory as one sprite of <symbol> elements,
+    inlined in the page so the icons need no requests of their own.
+    """
+
+    def __init__(self, images_dir, max_bytes=SPRITE_MAX_BYTES):
+        self.images_dir = images_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._icons = None
+
+    def _load(self):
+        """Parse the icons once: {name: (root attributes, content)}"""
+        with self._lock:
+            if self._icons is None:
+                icons = {}
+                for name in sorted(os.listdir(self.images_dir)):
+                    path = os.path.join(self.images_dir, name)
+                    if (
+                        not name.endswith(".svg")
+                        or os.path.getsize(path) > self.max_bytes
+                    ):
+                        continue
+                    with open(path, "r", encoding="utf-8") as f:
+                        match = SVG_ROOT.search(f.read())
+                    if match:
+                        attributes = dict(SVG_ATTRIBUTE.findall(match.group(1)))
+                        icons[name[: -len(".svg")]] = (attributes, match.group(2))
+                self._icons = icons
+        return self._icons
+
+    def markup(self):
+        """Return the hidden sprite, include it once per page"""
+        symbols = []
+        for name, (attributes, content) in self._load().items():
+            viewbox = attributes.get("viewBox", "0 0 24 24")
+            fill = attributes.get("fill", "currentColor")
+            symbols.append(
+                f'<symbol id="icon-{name}" viewBox="{viewbox}">'
+                f'<g fill="{fill}">{content}</g></symbol>'
+            )
+        return Markup(
+            '<svg xmlns="http://www.w3.org/2000/svg" style="display: none">'
+            + "".join(symbols)
+            + "</svg>"
+        )
+
+    def icon(self, name, label, css_class=""):
+        """Return an inline SVG showing an icon of the sprite"""
+        attributes = self._load()[name][0]
+        width = attributes.get("width", "24px")
+        height = attributes.get("height", "24px")
+        return Markup(
+            f'<svg class="{escape(css_class)}" width="{width}" height="{height}"'
+            f' role="img" aria-label="{escape(label)}">'
+            f'<use href="#icon-{name}"></use></svg>'
+        )
+
+
+def parse_args():
+    """Parse command line arguments and build the assets."""
+    if len(sys.argv) > 3:
+        print(f"Usage: {sys.argv[0]} [static_dir] [templates_dir]")
+        sys.exit(1)
+    build(*sys.argv[1:])
+
+
+if __name__ == "__main__":
+    parse_args()
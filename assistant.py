@@ -3,16 +3,19 @@
 import os
 import subprocess
 import json
+import queue
+import re
+import sqlite3
+import threading
 import requests
 
-# import sqlite3
 import pvporcupine
 import pyaudio
 import numpy as np
 from dotenv import load_dotenv
-from num2words import num2words as n2w
 from vosk import Model, KaldiRecognizer
-from word2number import w2n
+import intents
+from input_controller import controller as input_controller
 
 load_dotenv()
 os.environ["BROWSER"] = "chromium-browser"
@@ -27,95 +30,355 @@ DATABASE_PATH = f"{BASE_DIR}/recipes.db"
 WAKE_WORD_PATH = os.path.join(BASE_DIR, f"wake_words/{WAKE_WORD_FILE}")
 MODEL_PATH = os.path.join(BASE_DIR, f"models/{MODEL_FILE}")
 LED_PATH = "/sys/class/leds/ACT/brightness"
+NOTIFICATION_ID = 2593  # dunst replace id shared by all assistant notifications
 INPUT_DEVICE_INDEX = 1
+SAMPLE_RATE = 16000
+CAPTURE_FRAMES = 512  # Samples per microphone read in the capture thread
+VOSK_FRAMES = 4000  # Samples per Vosk AcceptWaveform call
+RING_SECONDS = 10  # Audio kept in the ring buffer
+# Low-latency mode: smaller Vosk reads and dispatch on partial results
+LOW_LATENCY = os.getenv("ASSISTANT_LOW_LATENCY", "0") == "1"
+LOW_LATENCY_FRAMES = 1600  # 100 ms
+# Seconds without new speech before giving up on a command
+SILENCE_TIMEOUT = float(os.getenv("ASSISTANT_SILENCE_TIMEOUT", "3"))
+GRAMMAR_CACHE_PATH = os.path.join(BASE_DIR, "grammar_cache.json")
+TIMER_MAX_MINUTES = 60
+KEYWORDS = intents.KEYWORDS
+grammar_generation = None  # Database generation of the loaded grammar
+
+
+class AudioRing:
+    """Capture thread writing microphone audio into a preallocated ring buffer"""
+
+    def __init__(self, stream, seconds=RING_SECONDS, max_read=VOSK_FRAMES):
+        self.stream = stream
+        self.capacity = seconds * SAMPLE_RATE
+        self.max_read = max_read
+        # The first max_read samples are mirrored past the end of the ring,
+        # so every read is a single contiguous view without copying
+        self.buffer = np.zeros(self.capacity + max_read, dtype=np.int16)
+        self.written = 0  # Total samples captured, readers keep cursors into it
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """Start the capture thread"""
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._capture, name="audio-capture", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stop the capture thread and wake up waiting readers"""
+        self._running = False
+        if self._thread:
+            self._thread.join(timeout=1)
+        with self._condition:
+            self._condition.notify_all()
+
+    def _capture(self):
+        """Read the stream until stopped or exhausted"""
+        while self._running:
+            pcm = self.stream.read(CAPTURE_FRAMES, exception_on_overflow=False)
+            if not pcm:
+                break
+            self._write(np.frombuffer(pcm, dtype=np.int16))
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+
+    def _write(self, pcm):
+        """Copy samples into the ring and publish them to readers"""
+        start = self.written % self.capacity
+        end = start + len(pcm)
+        if end <= self.capacity:
+            self.buffer[start:end] = pcm
+            head = (start, min(end, self.max_read))
+        else:
+            split = self.capacity - start
+            self.buffer[start : self.capacity] = pcm[:split]
+            self.buffer[: end - self.capacity] = pcm[split:]
+            head = (0, min(end - self.capacity, self.max_read))
+        if head[0] < head[1]:
+            self.buffer[
+                self.capacity + head[0] : self.capacity + head[1]
+            ] = self.buffer[head[0] : head[1]]
+        with self._condition:
+            self.written += len(pcm)
+            self._condition.notify_all()
+
+    def read(self, cursor, frames):
+        """
+        Wait for frames samples at cursor and return (next cursor, view).
+        The view is None once capture has stopped. A reader that fell more than
+        the ring size behind skips ahead to the newest audio.
+        Without a capture thread the stream is read synchronously instead,
+        which replays recorded audio without losing any of it.
+        """
+        if self._thread is None:
+            while self.written < cursor + frames:
+                pcm = self.stream.read(CAPTURE_FRAMES, exception_on_overflow=False)
+                if not pcm:
+                    return cursor, None
+                self._write(np.frombuffer(pcm, dtype=np.int16))
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self.written >= cursor + frames or not self._running
+            )
+            if self.written < cursor + frames:
+                return cursor, None
+            if self.written - cursor > self.capacity:
+                print(
+                    f"Audio overrun, skipped {self.written - frames - cursor} samples"
+                )
+                cursor = self.written - frames
+        start = cursor % self.capacity
+        return cursor + frames, self.buffer[start : start + frames]
+
+
+class ActionExecutor:
+    """
+    Run assistant side effects (LED, notifications, browser, HTTP) on a worker
+    thread so they never block the audio path. Queued actions are coalesced:
+    only the last LED state is written, and a close-all followed by a
+    notification becomes one replacing notification.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._led_file = None
+        self._led_sudo = False  # The LED node is not writable, write through sudo
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, action: str, *args):
+        """Queue an action, starting the worker on first use"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="assistant-actions", daemon=True
+                )
+                self._thread.start()
+        self._queue.put((action, args))
+
+    def shutdown(self, timeout: float = 2):
+        """Run the queued actions and stop the worker"""
+        if self._thread and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+        if self._led_file:
+            self._led_file.close()
+            self._led_file = None
+
+    def _run(self):
+        """Worker loop: drain the queue, coalesce and run the actions"""
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            for action, args in coalesce_actions(item for item in batch if item):
+                try:
+                    getattr(self, f"_{action}")(*args)
+                except (OSError, subprocess.CalledProcessError) as e:
+                    # Do not notify about failed notifications, it would loop
+                    error(f"Could not run {action}: {e}", notify=action == "led")
+                except Exception as e:  # pylint: disable=broad-except
+                    # Keep the worker alive, the rest of the batch must still run
+                    print(f"Could not run {action}: {e!r}")
+            if stop:
+                return
+
+    def _led(self, state: int):
+        """Write the LED state through a file handle kept open on the sysfs node"""
+        if self._led_file is None and not self._led_sudo:
+            try:
+                self._led_file = open(LED_PATH, "w", encoding="utf-8")
+            except PermissionError:
+                # No write access to the node, use sudo from now on
+                self._led_sudo = True
+        if self._led_sudo:
+            subprocess.run(
+                ["sudo", "tee", LED_PATH],
+                input=str(state),
+                text=True,
+                stdout=subprocess.DEVNULL,
+                check=True,
+            )
+            return
+        self._led_file.write(str(state))
+        self._led_file.flush()
+
+    def _notify(self, title: str, message: str):
+        """Show a notification, replacing the previous assistant notification"""
+        subprocess.run(
+            [
+                "dunstify",
+                "-r",
+                str(NOTIFICATION_ID),
+                title,
+                message,
+                "-i",
+                f"{BASE_DIR}/static/images/mic.png",
+            ],
+            check=True,
+        )
+
+    def _close(self):
+        """Close all notifications"""
+        subprocess.run(["dunstctl", "close-all"], check=True)
+
+    def _open(self, url: str):
+        """Open a URL in the default browser"""
+        subprocess.run(["xdg-open", url], check=True)
+
+    def _post(self, url: str, data: dict):
+        """POST a JSON command to the Flask app"""
+        try:
+            response = requests.post(url, json=data, timeout=5)
+            print(response.status_code)
+        except requests.exceptions.RequestException as e:
+            print(f"Error: {e}")
+
+
+def coalesce_actions(batch):
+    """Drop queued actions made redundant by later ones"""
+    actions = []
+    for action, args in batch:
+        if action == "led":
+            # Only the final LED state matters
+            actions = [queued for queued in actions if queued[0] != "led"]
+        elif action in ("close", "notify") and actions and actions[-1][0] == "close":
+            # A replacing notification or second close-all covers the close
+            actions.pop()
+        actions.append((action, args))
+    return actions
+
+
+actions = ActionExecutor()
 
 
 def led(state: int):
     """Turn the Raspberry Pi LED on or off"""
-    try:
-        subprocess.run(
-            f"echo {state} | sudo tee {LED_PATH} > /dev/null", shell=True, check=True
-        )
-    except subprocess.CalledProcessError:
-        error("Could not change LED state")
+    actions.submit("led", state)
 
 
 def push_notification(title: str, message: str):
     """Send a notification using dunst"""
-    try:
-        subprocess.run(
-            ["dunstify", title, message, "-i", f"{BASE_DIR}/static/images/mic.png"],
-            check=True,
-        )
-    except subprocess.CalledProcessError:
-        error("Could not send notification")
+    actions.submit("notify", title, message)
 
 
 def close_notifications():
     """Close all notifications using dunstctl"""
-    try:
-        subprocess.run(["dunstctl", "close-all"], check=True)
-    except subprocess.CalledProcessError:
-        error("Could not close notifications")
+    actions.submit("close")
 
 
 def xdg_open(url: str):
     """Open a URL in the default browser"""
-    try:
-        subprocess.run(["xdg-open", url], check=True)
-    except subprocess.CalledProcessError:
-        error("Could not open browser")
+    actions.submit("open", url)
 
 
 def scroll(direction: str):
     """Scroll the page up or down"""
+    if direction == "up":
+        input_controller.key("Page_Up")
+    elif direction == "down":
+        input_controller.key("Page_Down")
+
+
+def get_generation():
+    """Get the recipes generation from the database, 0 if it is not built yet"""
     try:
-        if direction == "up":
-            subprocess.run(["xdotool", "key", "Page_Up"], check=True)
-        elif direction == "down":
-            subprocess.run(["xdotool", "key", "Page_Down"], check=True)
-    except subprocess.CalledProcessError:
-        error("Could not scroll")
-
-
-# def get_recipes_size():
-#     """Get the number of recipes in the database"""
-#     try:
-#         conn = sqlite3.connect(DATABASE_PATH)
-#         cursor = conn.cursor()
-#         cursor.execute("SELECT COUNT(*) FROM recipes")
-#         recipes_size = cursor.fetchone()[0]
-#     except sqlite3.OperationalError:
-#         print("Error: Database not found")
-#     finally:
-#         conn.close()
-#     return recipes_size
-
-
-def get_grammar():
-    """Get the grammar for Vosk"""
-    # recipes_size = get_recipes_size()
-    # All numbers 1-99 using num2word
-    all_numbers = list(
-        # {word for i in range(1, recipes_size + 1) for word in n2w(i).split("-")}
-        {word for i in range(1, 100) for word in n2w(i).split("-")}
-    )
-    keywords = [
-        "show",
-        "all",
-        "open",
-        "recipe",
-        "recipes",
-        "number",
-        "scroll",
-        "up",
-        "down",
-        "timer",
-    ]
-    grammar = str(all_numbers + keywords).replace("'", '"')
+        conn = sqlite3.connect(f"file:{DATABASE_PATH}?mode=ro", uri=True)
+        try:
+            row = conn.execute(
+                "SELECT value FROM metadata WHERE key = 'generation'"
+            ).fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return 0
+    return row[0] if row else 0
+
+
+def get_recipe_vocabulary():
+    """Get the number of recipes and the words of their names and tags"""
+    try:
+        conn = sqlite3.connect(f"file:{DATABASE_PATH}?mode=ro", uri=True)
+        try:
+            rows = conn.execute("SELECT name, tags FROM recipes").fetchall()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        print("Error: Database not found")
+        return 0, set()
+    words = {
+        word
+        for name, tags in rows
+        for word in re.findall(r"[a-z]+", f"{name} {tags or ''}".lower())
+    }
+    return len(rows), words
+
+
+def build_grammar():
+    """Build the Vosk grammar for the recipes currently in the database"""
+    recipes_size, words = get_recipe_vocabulary()
+    # Numbers for recipe numbers and timer minutes, e.g. "one hundred and five"
+    numbers = {
+        word
+        for i in range(1, max(recipes_size, TIMER_MAX_MINUTES) + 1)
+        for word in intents.number_to_words(i).split()
+    }
+    return json.dumps(sorted(numbers | words | set(KEYWORDS)))
+
+
+def get_grammar(generation=None):
+    """Get the grammar for Vosk, cached on disk per database generation"""
+    if generation is None:
+        generation = get_generation()
+    key = f"{generation}:{','.join(KEYWORDS)}:{TIMER_MAX_MINUTES}"
+    try:
+        with open(GRAMMAR_CACHE_PATH, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached.get("key") == key:
+            return cached["grammar"]
+    except (OSError, ValueError):
+        pass
+
+    grammar = build_grammar()
+    try:
+        tmp_path = f"{GRAMMAR_CACHE_PATH}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"key": key, "grammar": grammar}, f)
+        os.replace(tmp_path, GRAMMAR_CACHE_PATH)
+    except OSError as e:
+        print(f"Could not cache grammar: {e}")
     return grammar
 
 
+def refresh_grammar(recognizer):
+    """Swap in a new grammar if the recipes changed since it was loaded"""
+    global grammar_generation  # pylint: disable=global-statement
+    generation = get_generation()
+    if generation != grammar_generation:
+        recognizer.SetGrammar(get_grammar(generation))
+        grammar_generation = generation
+        print(f"Loaded grammar for recipes generation {generation}")
+
+
+def create_recognizer(model_path=MODEL_PATH):
+    """Load the Vosk model and create a recognizer with the recipes grammar"""
+    model = Model(model_path)
+    recognizer = KaldiRecognizer(model, SAMPLE_RATE)
+    refresh_grammar(recognizer)
+    return recognizer
+
+
 def init():
     """Initialize Porcupine, PyAudio, and Vosk"""
     # Initialize Porcupine with your wake word
@@ -127,26 +390,81 @@ def init():
     audio = pyaudio.PyAudio()
 
     # Initialize Vosk speech recognition model
-    model = Model(MODEL_PATH)
-    recognizer = KaldiRecognizer(model, 16000)
-    grammar = get_grammar()
-    recognizer.SetGrammar(grammar)
+    recognizer = create_recognizer()
 
     # Open audio stream for microphone
     stream = audio.open(
         format=pyaudio.paInt16,
         channels=1,
-        rate=16000,
+        rate=SAMPLE_RATE,
         input=True,
         frames_per_buffer=4096,
         input_device_index=INPUT_DEVICE_INDEX,
     )
     stream.start_stream()
 
+    # Capture on a dedicated thread so audio is never dropped while processing
+    ring = AudioRing(stream, max_read=max(VOSK_FRAMES, LOW_LATENCY_FRAMES))
+    ring.start()
+
     print("Listening for 'Hey Cookbook'...")
     led(0)
     close_notifications()
-    return porcupine, audio, stream, recognizer
+    return porcupine, audio, ring, recognizer
+
+
+def show_recipes():
+    """Show the grid of all recipes"""
+    print("Showing all recipes")
+    xdg_open("http://localhost:8001/grid")
+
+
+def open_number(number: int):
+    """Open a recipe by its display number"""
+    print(f"Showing recipe number {number}")
+    xdg_open(f"http://localhost:8001/recipes/{number}")
+
+
+def open_name(words: tuple):
+    """Open the recipe whose name shares the most words with the command"""
+    try:
+        conn = sqlite3.connect(f"file:{DATABASE_PATH}?mode=ro", uri=True)
+        try:
+            rows = conn.execute("SELECT name, file_path FROM recipes").fetchall()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        print("Error: Database not found")
+        return
+    scored = sorted(
+        (-len(set(words) & set(re.findall(r"[a-z]+", name.lower()))), name, path)
+        for name, path in rows
+    )
+    if not scored or scored[0][0] == 0:
+        print(f"No recipe matches '{' '.join(words)}'")
+        return
+    print(f"Showing recipe {scored[0][1]}")
+    xdg_open(f"http://localhost:8001/recipes/{scored[0][2].split('.')[0]}")
+
+
+def set_timer(duration: int):
+    """Start a timer on the kiosk"""
+    print(f"Setting timer for {duration} minutes")
+    actions.submit(
+        "post",
+        "http://localhost:8001/commands",
+        {"action": "timer", "duration": duration},
+    )
+
+
+HANDLERS = {
+    intents.SHOW_RECIPES: show_recipes,
+    intents.OPEN_NUMBER: open_number,
+    intents.OPEN_NAME: open_name,
+    intents.SCROLL_UP: lambda: scroll("up"),
+    intents.SCROLL_DOWN: lambda: scroll("down"),
+    intents.TIMER: set_timer,
+}
 
 
 def parse(result: str):
@@ -156,82 +474,71 @@ def parse(result: str):
     print(f"Recognized: {result}")
     close_notifications()
     push_notification("Recognized", result)
-    if ("show" in result or "all" in result) and (
-        "recipes" in result or "recipe" in result
-    ):
-        print("Showing all recipes")
-        xdg_open("http://localhost:8001/grid")
-    elif "number" in result:
-        # Extract the first matching word from the result
+    intent, args = intents.match(result)
+    if intent is None:
+        print(f"No command in '{result}'")
+        return
+    HANDLERS[intent](*args)
 
-        try:
-            number = w2n.word_to_num(result)
-        except ValueError:
-            print(f"Could not convert '{result}' to a number")
-        print(f"Showing recipe number {number}")
-        # Execute in the background
-        xdg_open(f"http://localhost:8001/recipes/{number}")
-    elif "scroll" in result:
-        if "up" in result:
-            print("Scrolling up")
-            scroll("up")
-        elif "down" in result:
-            print("Scrolling down")
-            scroll("down")
-    elif "timer" in result:
-        duration = None
-        try:
-            duration = w2n.word_to_num(result)
-            response = requests.post(
-                "http://localhost:8001/commands",
-                json={"action": "timer", "duration": duration},
-                timeout=5,
-            )
-            print(response.status_code)
-        except ValueError:
-            print(f"Could not convert '{result}' to a number")
-        except requests.exceptions.RequestException as e:
-            print(f"Error: {e}")
 
-            # Check if "stop" is in the result (for stopping the loop)
-            # if "stop" in result.lower():
-            #     print("Stopping.")
-            #     break
-
-
-def vosk_listen(stream, recognizer):
-    """Listen for speech using Vosk"""
+def vosk_listen(ring, recognizer, cursor):
+    """Listen for speech using Vosk, starting at cursor, and return the new cursor"""
     # Once the wake word is detected, start speech recognition with Vosk
+    frames = LOW_LATENCY_FRAMES if LOW_LATENCY else VOSK_FRAMES
+    timeout = int(SILENCE_TIMEOUT * SAMPLE_RATE)
+    deadline = cursor + timeout
+    last_partial = ""
     while True:
         # Read the next audio chunk
-        pcm = stream.read(4000, exception_on_overflow=False)
-        if recognizer.AcceptWaveform(pcm):
+        cursor, pcm = ring.read(cursor, frames)
+        if pcm is None:
+            break
+        if recognizer.AcceptWaveform(pcm.tobytes()):
             parse(recognizer.Result())
-            led(0)
-            close_notifications()
             break
 
-        # Check partial result and print if available
-        # else:
-        #     partial_result = recognizer.PartialResult()
-        #     print(f"Partial result: {partial_result}")
+        # Check the partial result, dispatch complete commands without
+        # waiting for the trailing silence that finalizes the utterance
+        partial = json.loads(recognizer.PartialResult()).get("partial", "")
+        if LOW_LATENCY and intents.match(partial)[0] in intents.EARLY_INTENTS:
+            recognizer.Reset()
+            parse(json.dumps({"text": partial}))
+            break
+        if partial != last_partial:
+            # Speech is still coming in, extend the timeout
+            last_partial = partial
+            deadline = cursor + timeout
+        elif cursor >= deadline:
+            print(f"No command recognized: '{partial}'")
+            recognizer.Reset()
+            break
+    led(0)
+    close_notifications()
+    return cursor
 
 
-def error(message: str):
+def error(message: str, notify: bool = True):
     """Print an error message, log the error in file"""
     print(message)
-    push_notification("Error", message)
-    with open("/var/log/assistant.log", "a", encoding="utf-8") as f:
-        f.write(f"{message}\n")
+    if notify:
+        push_notification("Error", message)
+    try:
+        with open("/var/log/assistant.log", "a", encoding="utf-8") as f:
+            f.write(f"{message}\n")
+    except OSError as e:
+        # Called from the action worker, which must not die over the log file
+        print(f"Could not write the log: {e}")
 
 
-def loop(porcupine, audio, stream, recognizer):
+def loop(porcupine, audio, ring, recognizer):
     """Listen for the wake word and then listen for a command"""
+    cursor = ring.written
     try:
         while True:
-            # Read audio data from the microphone (this should be 512 samples)
-            pcm = stream.read(512, exception_on_overflow=False)
-            pcm = np.frombuffer(pcm, dtype=np.int16)
+            # Zero-copy view of the next 512 samples from the ring buffer
+            cursor, pcm = ring.read(cursor, porcupine.frame_length)
+            if pcm is None:
+                break
 
             # Process the audio chunk with Porcupine
             keyword_index = porcupine.process(pcm)
@@ -241,17 +548,23 @@ def loop(porcupine, audio, stream, recognizer):
                 print("Wake word detected! Listening for speech...")
                 led(1)
                 push_notification("Wake word detected", "Listening for command...")
-                vosk_listen(stream, recognizer)
+                # Pick up recipes added since the last command
+                refresh_grammar(recognizer)
+                # The command audio captured meanwhile is still in the ring
+                cursor = vosk_listen(ring, recognizer, cursor)
 
     finally:
         # Clean up resources
-        stream.stop_stream()
-        stream.close()
-        audio.terminate()
+        ring.stop()
+        ring.stream.stop_stream()
+        ring.stream.close()
+        if audio:
+            audio.terminate()
         porcupine.delete()
         led(0)
+        actions.shutdown()
 
 
 if __name__ == "__main__":
-    _porcupine, _audio, _stream, _recognizer = init()
-    loop(_porcupine, _audio, _stream, _recognizer)
+    _porcupine, _audio, _ring, _recognizer = init()
+    loop(_porcupine, _audio, _ring, _recognizer)
@@ -0,0 +1,312 @@
+""" Recipe database: connection settings, schema migrations and bulk writes. """
+
+import os
+import sqlite3
+import threading
+
+DEFAULT_PATH = "recipes.db"
+BUSY_TIMEOUT = 5.0  # Seconds a connection waits on a lock before failing
+MAX_PARAMETERS = 500  # Bound parameters per IN (...) query
+# Applied to every connection. WAL lets the web app keep reading while a
+# rebuild writes; NORMAL sync is durable across application crashes in WAL mode.
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "foreign_keys": "ON",
+    "temp_store": "MEMORY",
+    "cache_size": -8000,  # KiB
+    "busy_timeout": int(BUSY_TIMEOUT * 1000),
+}
+
+_connections = {}  # {path: (connection, inode of the file it opened)}
+_lock = threading.Lock()
+
+
+def configure(conn):
+    """Apply the connection pragmas, also used for the app's SQLAlchemy engine."""
+    cursor = conn.cursor()
+    for name, value in PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+def connect(db_path=DEFAULT_PATH):
+    """Open a new configured connection."""
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT)
+    conn.row_factory = sqlite3.Row
+    configure(conn)
+    return conn
+
+
+def _inode(db_path):
+    """Return the inode of a database file, None if it does not exist."""
+    try:
+        return os.stat(db_path).st_ino
+    except OSError:
+        return None
+
+
+def get_connection(db_path=DEFAULT_PATH):
+    """
+    Return the shared connection for a database, opening it on first use and
+    again when the file was deleted or replaced, e.g. by make clean.
+    """
+    with _lock:
+        conn, inode = _connections.get(db_path, (None, None))
+        if conn is not None and inode != _inode(db_path):
+            conn.close()
+            conn = None
+        if conn is None:
+            conn = connect(db_path)
+            _connections[db_path] = (conn, _inode(db_path))
+        return conn
+
+
+def close(db_path=DEFAULT_PATH):
+    """Close the shared connection for a database, if open."""
+    with _lock:
+        conn, _ = _connections.pop(db_path, (None, None))
+    if conn is not None:
+        conn.close()
+
+
+def _create_schema(cursor):
+    """Version 1: recipes, tag index, search index, generation and manifest."""
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS recipes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        file_path TEXT NOT NULL UNIQUE,
+        tags TEXT
+    )
+    """
+    )
+    # Normalized tag index, one row per recipe and tag
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'recipe_tags'")
+    migrate_tags = cursor.fetchone() is None
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS recipe_tags (
+        recipe_id INTEGER NOT NULL REFERENCES recipes (id) ON DELETE CASCADE,
+        tag TEXT NOT NULL,
+        PRIMARY KEY (recipe_id, tag)
+    ) WITHOUT ROWID
+    """
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS recipe_tags_tag ON recipe_tags (tag, recipe_id)"
+    )
+    if migrate_tags:
+        # Move the comma-separated tags column into the new table
+        cursor.execute("SELECT id, tags FROM recipes")
+        cursor.executemany(
+            "INSERT OR IGNORE INTO recipe_tags (recipe_id, tag) VALUES (?, ?)",
+            [
+                (recipe_id, tag.strip().lower())
+                for recipe_id, tags in cursor.fetchall()
+                for tag in (tags or "").split(",")
+                if tag.strip()
+            ],
+        )
+    # Full-text search index over the recipe text, rowid mirrors recipes.id
+    cursor.execute(
+        """
+    CREATE VIRTUAL TABLE IF NOT EXISTS recipes_fts USING fts5(
+        name, tags, ingredients, instructions, tokenize = 'unicode61'
+    )
+    """
+    )
+    # Index recipes added before the search table existed
+    cursor.execute(
+        """
+    INSERT INTO recipes_fts (rowid, name, tags)
+    SELECT id, name, replace(tags, ',', ' ') FROM recipes
+    WHERE id NOT IN (SELECT rowid FROM recipes_fts)
+    """
+    )
+    # Generation counter, bumped by every write that changes the recipes
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS metadata (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )
+    """
+    )
+    # Content hashes of the inputs each generated recipe was built from
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS build_manifest (
+        file_path TEXT PRIMARY KEY,
+        md_path TEXT NOT NULL,
+        md_hash TEXT NOT NULL,
+        image_hash TEXT,
+        template_hash TEXT NOT NULL,
+        stat TEXT NOT NULL
+    )
+    """
+    )
+
+
+# Schema migrations in order, the database's user_version counts those applied.
+# Databases created before versioning are at 0 and every step is idempotent.
+MIGRATIONS = [_create_schema]
+
+
+def setup_database(db_path=DEFAULT_PATH):
+    """
+    Create the database or bring its schema up to date.
+    Returns the schema version.
+    """
+    conn = get_connection(db_path)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        with conn:
+            conn.execute("BEGIN")  # Python only opens transactions before DML
+            migration(conn.cursor())
+            conn.execute(f"PRAGMA user_version = {number}")
+    return len(MIGRATIONS)
+
+
+def save_recipes(recipes, db_path=DEFAULT_PATH):
+    """
+    Insert or update many recipes in a single transaction.
+    Each item is a (file_path, Recipe) pair.
+    """
+    conn = get_connection(db_path)
+    with conn:
+        _upsert_recipes(conn, recipes)
+        bump_generation(conn)
+
+
+def save_build(recipes, manifest_rows, removed, db_path=DEFAULT_PATH):
+    """
+    Write built recipes, the refreshed manifest and the removal of deleted
+    recipes in a single transaction.
+    """
+    conn = get_connection(db_path)
+    with conn:
+        _upsert_recipes(conn, recipes)
+        conn.executemany(
+            """
+        INSERT INTO build_manifest
+        (file_path, md_path, md_hash, image_hash, template_hash, stat)
+        VALUES (:file_path, :md_path, :md_hash, :image_hash, :template_hash, :stat)
+        ON CONFLICT (file_path) DO UPDATE SET
+            md_path = excluded.md_path,
+            md_hash = excluded.md_hash,
+            image_hash = excluded.image_hash,
+            template_hash = excluded.template_hash,
+            stat = excluded.stat
+        """,
+            manifest_rows,
+        )
+        _delete_recipes(conn, removed)
+        if recipes or removed:
+            bump_generation(conn)
+
+
+def _upsert_recipes(conn, recipes):
+    """Upsert recipe rows, then replace their tags and search index entries."""
+    recipes = list(recipes)
+    if not recipes:
+        return
+    conn.executemany(
+        """
+    INSERT INTO recipes (name, file_path, tags) VALUES (?, ?, ?)
+    ON CONFLICT (file_path) DO UPDATE SET name = excluded.name, tags = excluded.tags
+    """,
+        [
+            (recipe.name, file_path, ",".join(recipe.tags))
+            for file_path, recipe in recipes
+        ],
+    )
+    ids = _recipe_ids(conn, [file_path for file_path, _ in recipes])
+    conn.executemany(
+        "DELETE FROM recipe_tags WHERE recipe_id = ?",
+        [(ids[file_path],) for file_path, _ in recipes],
+    )
+    conn.executemany(
+        "INSERT OR IGNORE INTO recipe_tags (recipe_id, tag) VALUES (?, ?)",
+        [
+            (ids[file_path], tag)
+            for file_path, recipe in recipes
+            for tag in recipe.tags
+            if tag
+        ],
+    )
+    # Keep the full-text search index in sync
+    conn.executemany(
+        "DELETE FROM recipes_fts WHERE rowid = ?",
+        [(ids[file_path],) for file_path, _ in recipes],
+    )
+    conn.executemany(
+        """
+    INSERT INTO recipes_fts (rowid, name, tags, ingredients, instructions)
+    VALUES (?, ?, ?, ?, ?)
+    """,
+        [
+            (
+                ids[file_path],
+                recipe.name,
+                " ".join(recipe.tags),
+                "\n".join(recipe.ingredients),
+                "\n".join(recipe.instructions),
+            )
+            for file_path, recipe in recipes
+        ],
+    )
+
+
+def _delete_recipes(conn, file_paths):
+    """Delete recipes with their tags, search index and manifest entries."""
+    file_paths = list(file_paths)
+    ids = [(recipe_id,) for recipe_id in _recipe_ids(conn, file_paths).values()]
+    conn.executemany("DELETE FROM recipe_tags WHERE recipe_id = ?", ids)
+    conn.executemany("DELETE FROM recipes_fts WHERE rowid = ?", ids)
+    conn.executemany("DELETE FROM recipes WHERE id = ?", ids)
+    conn.executemany(
+        "DELETE FROM build_manifest WHERE file_path = ?",
+        [(file_path,) for file_path in file_paths],
+    )
+
+
+def _recipe_ids(conn, file_paths):
+    """Return {file_path: id} for the given recipe files."""
+    file_paths = list(file_paths)
+    ids = {}
+    # One query per chunk, within SQLite's bound parameter limit
+    for start in range(0, len(file_paths), MAX_PARAMETERS):
+        chunk = file_paths[start : start + MAX_PARAMETERS]
+        ids.update(
+            conn.execute(
+                "SELECT file_path, id FROM recipes WHERE file_path IN (%s)"
+                % ",".join("?" * len(chunk)),
+                chunk,
+            ).fetchall()
+        )
+    return ids
+
+
+def bump_generation(conn):
+    """
+    Increment the recipes generation so readers can tell the data changed.
+    """
+    # A new database starts from the current time, so readers do not confuse
+    # its generations with those of a deleted one (make clean)
+    conn.execute(
+        """
+    INSERT INTO metadata (key, value)
+    VALUES ('generation', CAST(strftime('%s', 'now') AS INTEGER))
+    ON CONFLICT (key) DO UPDATE SET value = value + 1
+    """
+    )
+
+
+def load_manifest(db_path=DEFAULT_PATH):
+    """Return the build manifest as a dict keyed by output file name."""
+    return {
+        row["file_path"]: dict(row)
+        for row in get_connection(db_path).execute("SELECT * FROM build_manifest")
+    }
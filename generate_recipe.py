@@ -1,161 +1,665 @@
-""" Generate a recipe HTML file from a markdown file and update the database. """
+""" Generate recipe HTML files from markdown and update the database. """
 
+import hashlib
+import io
+import re
 import sys
 import os
-import sqlite3
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+import assets
+import database
+from jinja2 import Environment, FileSystemLoader, meta, select_autoescape
 
-def setup_database(db_path="recipes.db"):
-    """
-    Create or connect to the database and ensure the `recipes` table exists.
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+GENERATED_DIR = "templates/recipes"
+TEMPLATE_FILE = "templates/recipe.html"
+IMAGES_DIR = "static/images"
+IMAGE_WIDTH = 400
+THUMBNAIL_SIZE = (320, 240)  # 4:3, like the /grid card figures
+CACHE_DIGEST_LENGTH = 20  # Hex digits of the source image hash naming cached images
+STATIC_DIR = "static"
+STATIC_URL = "/static"  # Flask's default static_url_path
+WATCH_DEBOUNCE = 1.0  # Seconds without changes that end a burst
+WATCH_MAX_DELAY = 10.0  # Longest a burst delays its rebuild
+WATCH_POLL_INTERVAL = 2.0  # Without inotify
+_WORKER_TEMPLATE = None
+_asset_manifest = assets.Manifest(STATIC_DIR, os.path.dirname(TEMPLATE_FILE))
+_environments = {}
+
+
+def update_recipe_in_database(
+    name, file_path, tags, ingredients=(), instructions=(), db_path="recipes.db"
+):
     """
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-    CREATE TABLE IF NOT EXISTS recipes (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        file_path TEXT NOT NULL UNIQUE,
-        tags TEXT
-    )
+    Insert or update a recipe entry in the database, its tags and its search index.
     """
-    )
-    conn.commit()
-    conn.close()
+    recipe = Recipe(name)
+    recipe.tags.extend(tags)
+    recipe.ingredients.extend(ingredients)
+    recipe.instructions.extend(instructions)
+    database.save_recipes([(file_path, recipe)], db_path)
 
 
-def update_recipe_in_database(name, file_path, tags, db_path="recipes.db"):
+class Recipe:
     """
-    Insert or update a recipe entry in the database.
+    A recipe parsed from markdown, shared by rendering, the database and search.
     """
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
 
-    # Check if the recipe already exists
-    cursor.execute("SELECT id FROM recipes WHERE file_path = ?", (file_path,))
-    recipe = cursor.fetchone()
+    __slots__ = (
+        "name",
+        "ingredients",
+        "instructions",
+        "tags",
+        "servings",
+        "prep_time",
+        "source",
+        "sections",
+    )
+
+    def __init__(self, name=None):
+        self.name = name
+        self.ingredients = []
+        self.instructions = []
+        self.tags = []
+        self.servings = None
+        self.prep_time = None
+        self.source = None
+        self.sections = {}  # Other "## Title" sections: title -> lines
+
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
 
-    if recipe:
-        # Update existing recipe
-        cursor.execute(
-            """
-        UPDATE recipes
-        SET name = ?, tags = ?
-        WHERE file_path = ?
-        """,
-            (name, ",".join(tags), file_path),
-        )
-    else:
-        # Insert new recipe
-        cursor.execute(
-            """
-        INSERT INTO recipes (name, file_path, tags)
-        VALUES (?, ?, ?)
-        """,
-            (name, file_path, ",".join(tags)),
-        )
 
-    conn.commit()
-    conn.close()
+# Section headings, matched by prefix like "## Ingredients (for 4)"
+SECTIONS = {
+    "ingredients": "ingredients",
+    "instructions": "instructions",
+    "directions": "instructions",
+    "method": "instructions",
+    "steps": "instructions",
+    "tags": "tags",
+    "servings": "servings",
+    "serves": "servings",
+    "prep time": "prep_time",
+    "time": "prep_time",
+    "source": "source",
+}
+METADATA = {"servings", "prep_time", "source"}
+LIST_ITEM = re.compile(r"^(?:[-*+]\s*|\d+[.)]\s+)")
+METADATA_LINE = re.compile(r"^([A-Za-z ]+?)\s*:\s*(\S.*)$")
 
 
-def parse_markdown(md_file):
+def parse_markdown(md_file, content=None):
     """
-    Parse the markdown file into name, ingredients, and instructions.
+    Parse the markdown file line by line into a Recipe: name, ingredients,
+    instructions, tags, metadata (servings, prep time, source URL) and any
+    other sections. content is the file's bytes when the caller already read
+    them, otherwise the file is streamed.
     """
-    name = None
-    ingredients = []
-    instructions = []
-    tags = []
-
+    if content is not None:
+        # Iterated like the file, with the same newline handling
+        lines = io.StringIO(content.decode("utf-8"), newline=None)
+        return _parse_lines(lines, md_file)
     with open(md_file, "r", encoding="utf-8") as f:
-        lines = f.readlines()
+        return _parse_lines(f, md_file)
+
 
+def _parse_lines(lines, md_file):
+    """Parse markdown lines into a Recipe, md_file names it when untitled"""
+    recipe = Recipe()
     section = None
     for line in lines:
         line = line.strip()
+        if not line:
+            continue
         if line.startswith("# "):  # Title
-            name = line[2:]
-        elif line.startswith("## Ingredients"):  # Ingredients section
-            section = "ingredients"
-        elif line.startswith("## Instructions"):  # Instructions section
-            section = "instructions"
-        elif line.startswith("## Tags"):  # Tags section
-            section = "tags"
-        elif line.startswith("##"):  # Unrecognized section (skip for now)
+            recipe.name = line[2:].strip()
             section = None
-        elif section == "ingredients" and line[:1] in {
-            "-",
-            "*",
-            "+",
-        }:  # Ingredient item
-            ingredients.append(line[2:])
-        elif section == "instructions" and line:  # Instruction line
-            instructions.append(line)
-        elif section == "tags" and line:  # Tag line
-            tags = line.split(",")
-            tags = [tag.strip().lower() for tag in tags]
+        elif line.startswith("##"):  # Section heading
+            title = line.lstrip("#").strip()
+            key = title.lower()
+            section = next(
+                (name for prefix, name in SECTIONS.items() if key.startswith(prefix)),
+                title,
+            )
+            if section == title:
+                recipe.sections.setdefault(title, [])
+        elif section == "instructions":  # Instruction line
+            recipe.instructions.append(line)
+        elif section == "ingredients" and LIST_ITEM.match(line):  # Ingredient item
+            recipe.ingredients.append(LIST_ITEM.sub("", line, count=1))
+        elif section == "tags":  # Tag line, may be one of several
+            for tag in line.split(","):
+                tag = tag.strip().lower()
+                if tag and tag not in recipe.tags:
+                    recipe.tags.append(tag)
+        elif section in METADATA:  # Value under a metadata heading
+            if getattr(recipe, section) is None:
+                setattr(recipe, section, LIST_ITEM.sub("", line, count=1))
+        elif not parse_metadata_line(recipe, line) and section in recipe.sections:
+            recipe.sections[section].append(line)
+
+    if recipe.name is None:
+        # Fall back to the file name, e.g. apple_pie.md -> Apple Pie
+        stem = os.path.splitext(os.path.basename(md_file))[0]
+        recipe.name = " ".join(word.capitalize() for word in stem.split("_"))
+    return recipe
+
 
-    return name, ingredients, instructions, tags
+def parse_metadata_line(recipe, line):
+    """
+    Store a "Servings: 4" style line on the recipe, return True if it was one.
+    """
+    match = METADATA_LINE.match(LIST_ITEM.sub("", line, count=1))
+    if not match:
+        return False
+    key = next(
+        (
+            name
+            for prefix, name in SECTIONS.items()
+            if name in METADATA and match.group(1).lower() == prefix
+        ),
+        None,
+    )
+    if key is None or getattr(recipe, key) is not None:
+        return False
+    setattr(recipe, key, match.group(2))
+    return True
 
 
 def generate_html_output(md_file, output_file, template_file, image_file=None):
     """
     Generate an HTML file with the desired template structure from the markdown content.
     """
-    # Parse markdown content into name, ingredients, and instructions
-    name, ingredients, instructions, tags = parse_markdown(md_file)
-
-    # Read the template
-    with open(template_file, "r", encoding="utf-8") as f:
-        template = f.read()
-
-    # Generate the content for each block
-    image_tag = (
-        f"""
-        <img class="recipe-main" src="{{{{ url_for('static',
-        filename='images/{os.path.basename(image_file)}') }}}}" alt="{name} image">
-        """
-        if image_file
-        else ""
-    )
+    return build_recipe(md_file, output_file, load_template(template_file), image_file)
 
-    ingredients_html = "\n".join(
-        [f"<li>{ingredient}</li>" for ingredient in ingredients]
-    )
 
-    instructions_html = "\n".join(
-        [f"<p>{instruction}</p>" for instruction in instructions]
-    )
+def static_url(endpoint, filename):
+    """Build-time url_for, only static files are linked from recipe pages."""
+    if endpoint != "static":
+        raise ValueError(f"Cannot build a URL for {endpoint} at build time")
+    # Link the fingerprinted build of an asset, like the app's url_for
+    return f"{STATIC_URL}/{_asset_manifest.get(filename) or filename}"
 
-    # Replace the placeholders in the template with actual content
-    output_html = template
-    output_html = output_html.replace("{name}", name)
-    output_html = output_html.replace("{image_tag}", image_tag)
-    output_html = output_html.replace("{ingredients_html}", ingredients_html)
-    output_html = output_html.replace("{instructions_html}", instructions_html)
 
-    # Write the generated HTML to the output file
-    with open(output_file, "w", encoding="utf-8") as f:
-        f.write(output_html)
+def template_environment(templates_dir):
+    """Return the Jinja environment for a templates directory, created once."""
+    env = _environments.get(templates_dir)
+    if env is None:
+        env = Environment(
+            loader=FileSystemLoader(templates_dir),
+            autoescape=select_autoescape(["html"]),
+            trim_blocks=True,
+            lstrip_blocks=True,
+        )
+        env.globals["url_for"] = static_url
+        _environments[templates_dir] = env
+    return env
+
+
+def load_template(template_file):
+    """Compile the recipe template, extending templates from its directory."""
+    env = template_environment(os.path.dirname(os.path.abspath(template_file)))
+    return env.get_template(os.path.basename(template_file))
+
+
+def template_digest(template_file):
+    """
+    Return a SHA-256 digest of the template and every template it extends or
+    includes, so editing base.html also rebuilds the recipes. The built
+    asset names are part of it, the pages link them.
+    """
+    env = template_environment(os.path.dirname(os.path.abspath(template_file)))
+    digest = hashlib.sha256()
+    pending, seen = [os.path.basename(template_file)], set()
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        source = env.loader.get_source(env, name)[0]
+        digest.update(name.encode("utf-8") + b"\0" + source.encode("utf-8"))
+        pending.extend(
+            parent
+            for parent in meta.find_referenced_templates(env.parse(source))
+            if parent is not None
+        )
+    for name, built in sorted(_asset_manifest.files().items()):
+        digest.update(f"{name}\0{built}\0".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def build_recipe(md_file, output_file, template, image_file=None, content=None):
+    """
+    Parse one markdown file, write its HTML output and downsampled image.
+    content is the markdown's bytes when plan_build already read them.
+    Returns the parsed Recipe for the database and search index.
+    """
+    # Parse markdown content, the file is read once
+    recipe = parse_markdown(md_file, content)
 
     # Copy the image to /static folder while downsampling it to 400px width
+    webp = False
     if image_file:
+        webp = process_image(image_file)
+    else:
+        # The image may have been deleted since the last build
+        remove_images(os.path.splitext(os.path.basename(output_file))[0])
+
+    # Write the generated HTML to the output file
+    with open(output_file, "w", encoding="utf-8") as f:
+        f.write(render_recipe(template, recipe, image_file, webp))
+
+    return recipe
+
+
+def process_image(image_file, images_dir=IMAGES_DIR):
+    """
+    Write the 400px recipe image, its WebP variant and a 4:3 grid thumbnail.
+    Outputs are cached by the content hash of the source image, so unchanged
+    images are not decoded again. Returns True if the WebP variants exist.
+    """
+    stem = os.path.splitext(os.path.basename(image_file))[0]
+    if Image is None:
+        # Pillow is not installed, fall back to ImageMagick for the JPEG only
         os.system(
-            f"convert {image_file} -resize 400x static/images/{os.path.basename(image_file)}"
+            f"convert {image_file} -resize {IMAGE_WIDTH}x {images_dir}/{stem}.jpg"
         )
+        return False
 
-    return name, tags
+    cache_dir = os.path.join(images_dir, "generated", "cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    digest = file_hash(image_file)[:CACHE_DIGEST_LENGTH]
+    outputs = {
+        os.path.join(cache_dir, f"{digest}_w{IMAGE_WIDTH}.jpg"): os.path.join(
+            images_dir, f"{stem}.jpg"
+        ),
+        os.path.join(cache_dir, f"{digest}_w{IMAGE_WIDTH}.webp"): os.path.join(
+            images_dir, "generated", f"{stem}.webp"
+        ),
+        os.path.join(cache_dir, f"{digest}_t{THUMBNAIL_SIZE[0]}.webp"): os.path.join(
+            images_dir, "generated", f"{stem}_thumb.webp"
+        ),
+    }
+    if not all(os.path.isfile(cached) for cached in outputs):
+        jpeg, webp, thumbnail = outputs
+        with Image.open(image_file) as img:
+            # Let the JPEG decoder downscale by a power of two while decoding
+            img.draft("RGB", (IMAGE_WIDTH, IMAGE_WIDTH))
+            img = ImageOps.exif_transpose(img).convert("RGB")
+            if img.width > IMAGE_WIDTH:
+                img = img.resize(
+                    (IMAGE_WIDTH, round(img.height * IMAGE_WIDTH / img.width)),
+                    Image.Resampling.LANCZOS,
+                    reducing_gap=2.0,
+                )
+            _save_atomic(img, jpeg, "JPEG", quality=85, optimize=True)
+            _save_atomic(img, webp, "WEBP", quality=80, method=4)
+            _save_atomic(
+                ImageOps.fit(img, THUMBNAIL_SIZE, Image.Resampling.LANCZOS),
+                thumbnail,
+                "WEBP",
+                quality=75,
+                method=4,
+            )
+
+    for cached, target in outputs.items():
+        _link(cached, target)
+    return True
+
+
+def _save_atomic(img, path, image_format, **params):
+    """Save an image under a temporary name and move it into place."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    img.save(tmp_path, image_format, **params)
+    os.replace(tmp_path, path)
+
+
+def _link(source, target):
+    """Point target at a cached output, hard-linking when possible."""
+    if os.path.exists(target) and os.path.samefile(source, target):
+        # Already linked; renaming a link onto itself would leave tmp_path behind
+        return
+    tmp_path = f"{target}.{os.getpid()}.tmp"
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, target)
+
+
+def render_recipe(template, recipe, image_file=None, webp=False):
+    """
+    Render the compiled recipe template to the final static HTML page.
+    """
+    return template.render(
+        recipe=recipe,
+        image=os.path.splitext(os.path.basename(image_file))[0] if image_file else None,
+        webp=webp,
+    )
+
+
+def _init_worker(template_file):
+    """Compile the template once in each worker process instead of per task."""
+    global _WORKER_TEMPLATE  # pylint: disable=global-statement
+    _WORKER_TEMPLATE = load_template(template_file)
+
+
+def _build_worker(md_file, output_file, image_file, content):
+    """Build one recipe inside a pool worker."""
+    return build_recipe(md_file, output_file, _WORKER_TEMPLATE, image_file, content)
+
+
+def file_hash(path):
+    """Return the SHA-256 hex digest of a file, or None if it does not exist."""
+    if path is None or not os.path.isfile(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_stat(*paths):
+    """Return a cheap size/mtime signature of files, to skip rehashing them."""
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature.append(f"{stat.st_size}:{stat.st_mtime_ns}")
+        except (OSError, TypeError):
+            signature.append("-")
+    return "|".join(signature)
+
+
+def plan_build(recipes_dir, output_dir, template_hash, manifest, only=None):
+    """
+    Compare the recipes directory against the build manifest, or only the
+    recipes whose file stems are in only.
+    Returns the stale (md_file, output_file, image_file, content) tasks, the
+    manifest rows to write for every current recipe and the outputs of removed
+    recipes. content holds the markdown bytes read for hashing, so the build
+    parses them instead of reading the file again, None if it was not read.
+    """
+    stale = []
+    rows = {}
+    for entry in sorted(os.listdir(recipes_dir)):
+        stem, ext = os.path.splitext(entry)
+        if ext != ".md" or (only is not None and stem not in only):
+            continue
+        md_file = os.path.abspath(os.path.join(recipes_dir, entry))
+        output_file = os.path.join(output_dir, f"{stem}.html")
+        image_file = os.path.join(os.path.dirname(md_file), f"{stem}.jpg")
+        image_file = image_file if os.path.isfile(image_file) else None
+        file_path = os.path.basename(output_file)
+        stat = file_stat(md_file, image_file)
+
+        previous = manifest.get(file_path)
+        content = None
+        if previous and previous["stat"] == stat and previous["md_path"] == md_file:
+            # Unchanged since the last build, no need to read the files
+            row = dict(previous, template_hash=template_hash)
+        else:
+            with open(md_file, "rb") as f:
+                content = f.read()
+            row = {
+                "file_path": file_path,
+                "md_path": md_file,
+                "md_hash": hashlib.sha256(content).hexdigest(),
+                "image_hash": file_hash(image_file),
+                "template_hash": template_hash,
+                "stat": stat,
+            }
+        rows[file_path] = row
+
+        if (
+            previous is None
+            or not os.path.isfile(output_file)
+            or any(
+                previous[key] != row[key]
+                for key in ("md_hash", "image_hash", "template_hash")
+            )
+        ):
+            stale.append((md_file, output_file, image_file, content))
+
+    # Recipes built from this directory whose markdown has since been deleted
+    source_dir = os.path.abspath(recipes_dir)
+    removed = [
+        file_path
+        for file_path, previous in manifest.items()
+        if file_path not in rows
+        and (only is None or os.path.splitext(file_path)[0] in only)
+        and os.path.dirname(previous["md_path"]) == source_dir
+        and not os.path.isfile(previous["md_path"])
+    ]
+    return stale, rows, removed
+
+
+def remove_outputs(file_path, output_dir):
+    """Delete the generated HTML and images of a removed recipe."""
+    html_file = os.path.join(output_dir, file_path)
+    if os.path.isfile(html_file):
+        os.remove(html_file)
+    remove_images(os.path.splitext(file_path)[0])
+
+
+def remove_images(stem, images_dir=IMAGES_DIR):
+    """Delete the images generated for a recipe."""
+    for path in (
+        os.path.join(images_dir, f"{stem}.jpg"),
+        os.path.join(images_dir, "generated", f"{stem}.webp"),
+        os.path.join(images_dir, "generated", f"{stem}_thumb.webp"),
+    ):
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def prune_image_cache(image_hashes, images_dir=IMAGES_DIR):
+    """Delete the cached images of source images no recipe uses anymore."""
+    cache_dir = os.path.join(images_dir, "generated", "cache")
+    if not os.path.isdir(cache_dir):
+        return
+    digests = {image_hash[:CACHE_DIGEST_LENGTH] for image_hash in image_hashes}
+    for name in os.listdir(cache_dir):
+        # Skip the temporary files of images being written
+        if not name.endswith(".tmp") and name.split("_", 1)[0] not in digests:
+            os.remove(os.path.join(cache_dir, name))
+
+
+def build_all(
+    recipes_dir,
+    output_dir=GENERATED_DIR,
+    template_file=TEMPLATE_FILE,
+    db_path="recipes.db",
+    jobs=None,
+    only=None,
+):
+    """
+    Rebuild exactly the recipes in recipes_dir whose markdown, image or the
+    template changed since the last build, and drop recipes whose markdown was
+    deleted. only limits the check to a set of file stems. Rendering runs
+    across a process pool and all database changes are written in one
+    transaction. Prints the time spent in each phase.
+    """
+    timings = {}
+    start = time.perf_counter()
+
+    os.makedirs(output_dir, exist_ok=True)
+    database.setup_database(db_path)
+    template = load_template(template_file)
+    template_hash = template_digest(template_file)
+    stale, rows, removed = plan_build(
+        recipes_dir, output_dir, template_hash, database.load_manifest(db_path), only
+    )
+    timings["scan"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    built = []
+    failed = set()
+    if len(stale) > 1 and jobs != 1:
+        with ProcessPoolExecutor(
+            max_workers=jobs, initializer=_init_worker, initargs=(template_file,)
+        ) as pool:
+            futures = {pool.submit(_build_worker, *task): task for task in stale}
+            for future in as_completed(futures):
+                md_file, output_file, _, _ = futures[future]
+                try:
+                    built.append((output_file, future.result()))
+                except Exception as e:  # pylint: disable=broad-except
+                    print(f"Error building {md_file}: {e}")
+                    failed.add(os.path.basename(output_file))
+    else:
+        for md_file, output_file, image_file, content in stale:
+            try:
+                built.append(
+                    (
+                        output_file,
+                        build_recipe(
+                            md_file, output_file, template, image_file, content
+                        ),
+                    )
+                )
+            except Exception as e:  # pylint: disable=broad-except
+                print(f"Error building {md_file}: {e}")
+                failed.add(os.path.basename(output_file))
+    for file_path in removed:
+        remove_outputs(file_path, output_dir)
+    timings["render"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    database.save_build(
+        [(os.path.basename(output_file), recipe) for output_file, recipe in built],
+        # Failed recipes keep no manifest entry so the next build retries them
+        [row for file_path, row in rows.items() if file_path not in failed],
+        removed,
+        db_path,
+    )
+    prune_image_cache(
+        row["image_hash"]
+        for row in database.load_manifest(db_path).values()
+        if row["image_hash"]
+    )
+    timings["database"] = time.perf_counter() - start
+
+    print(f"Built {len(built)} of {len(stale)} stale recipes, removed {len(removed)}")
+    for phase, seconds in timings.items():
+        print(f"  {phase}: {seconds:.3f}s")
+    return built
+
+
+def watch(recipes_dir, **options):
+    """
+    Rebuild recipes as their files change. Bursts of changes, such as a git
+    pull, are collected until the directory has been quiet for WATCH_DEBOUNCE
+    seconds and then built together. Takes the options of build_all.
+    """
+    build_all(recipes_dir, **options)  # Catch up with changes made meanwhile
+    print(f"Watching {recipes_dir} for changes")
+    for stems in watch_changes(recipes_dir):
+        print(f"Changed: {'everything' if stems is None else ', '.join(sorted(stems))}")
+        try:
+            build_all(recipes_dir, only=stems, **options)
+        except Exception as e:  # pylint: disable=broad-except
+            print(f"Error rebuilding {recipes_dir}: {e}")
+
+
+def watch_changes(recipes_dir):
+    """
+    Yield the set of changed recipe file stems after every burst of changes,
+    or None when the whole directory has to be rescanned. Uses inotify when
+    inotify_simple is installed and polls the directory otherwise.
+    """
+    if INotify is None:
+        yield from poll_changes(recipes_dir)
+        return
+
+    inotify = INotify()
+    inotify.add_watch(
+        recipes_dir,
+        flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM | flags.DELETE,
+    )
+    while True:
+        events = inotify.read()  # Block until the first change of a burst
+        stems = set()
+        deadline = time.monotonic() + WATCH_MAX_DELAY
+        while events:
+            for event in events:
+                if event.mask & flags.Q_OVERFLOW:
+                    stems = None  # Events were lost
+                elif stems is not None:
+                    stem, ext = os.path.splitext(event.name)
+                    if ext in (".md", ".jpg"):
+                        stems.add(stem)
+            timeout = min(WATCH_DEBOUNCE, deadline - time.monotonic())
+            if timeout <= 0:
+                break
+            events = inotify.read(timeout=int(timeout * 1000))
+        if stems is None or stems:
+            yield stems
+
+
+def poll_changes(recipes_dir):
+    """Polling fallback of watch_changes, comparing size and mtime of the files"""
+    previous = scan_files(recipes_dir)
+    while True:
+        time.sleep(WATCH_POLL_INTERVAL)
+        current = scan_files(recipes_dir)
+        stems = set()
+        while current != previous:
+            stems.update(
+                os.path.splitext(name)[0]
+                for name in previous.keys() | current.keys()
+                if previous.get(name) != current.get(name)
+            )
+            previous = current
+            time.sleep(WATCH_DEBOUNCE)
+            current = scan_files(recipes_dir)
+        if stems:
+            yield stems
+
+
+def scan_files(recipes_dir):
+    """Return {name: size and mtime} of the recipe markdown and images"""
+    return {
+        entry.name: file_stat(entry.path)
+        for entry in os.scandir(recipes_dir)
+        if entry.name.endswith((".md", ".jpg"))
+    }
 
 
 def parse_args():
     """Parse command line arguments and call the main function."""
+    if len(sys.argv) in (3, 4) and sys.argv[1] == "build":
+        build_all(sys.argv[2], jobs=int(sys.argv[3]) if len(sys.argv) == 4 else None)
+        return
+    if len(sys.argv) in (3, 4) and sys.argv[1] == "watch":
+        watch(sys.argv[2], jobs=int(sys.argv[3]) if len(sys.argv) == 4 else None)
+        return
+
     if len(sys.argv) < 4 or len(sys.argv) > 5:
         print(
             "Usage: python generate_recipe.py <markdown_file> <output_file> <template_file> \
 [image_file]"
         )
+        print("       python generate_recipe.py build <recipes_dir> [jobs]")
+        print("       python generate_recipe.py watch <recipes_dir> [jobs]")
         sys.exit(1)
 
     md_file = sys.argv[1]
@@ -164,12 +668,12 @@ def parse_args():
     image_file = sys.argv[4] if len(sys.argv) == 5 else None
 
     # Ensure the database is set up
-    setup_database()
+    database.setup_database()
 
-    name, tags = generate_html_output(md_file, output_file, template_file, image_file)
+    recipe = generate_html_output(md_file, output_file, template_file, image_file)
 
     # Update the database with the new recipe
-    update_recipe_in_database(name, output_file.split("/")[-1], tags)
+    database.save_recipes([(output_file.split("/")[-1], recipe)])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,156 @@
+""" Long-lived X11 input controller shared by the Flask app and the assistant. """
+
+import logging
+import os
+import queue
+import subprocess
+import threading
+
+import metrics
+
+try:
+    from Xlib import X, XK
+    from Xlib.display import Display
+    from Xlib.ext import xtest
+except ImportError:
+    Display = None
+
+logger = logging.getLogger(__name__)
+
+# xdotool-style modifier names to X keysym names
+MODIFIERS = {
+    "ctrl": "Control_L",
+    "shift": "Shift_L",
+    "alt": "Alt_L",
+    "super": "Super_L",
+}
+SCROLL_UP = 4
+SCROLL_DOWN = 5
+POINTER_POSITION = (100, 100)  # Where the pointer is moved before scrolling
+
+
+class InputController:
+    """
+    Send key presses and scroll clicks to the X display over one persistent
+    XTest connection. Events are queued and handled on a worker thread, and
+    runs of the same event are coalesced into one batch with a single flush.
+    Falls back to xdotool when python-xlib is missing or the display is down.
+    """
+
+    def __init__(self, display=None):
+        self.display_name = display or os.environ.get("DISPLAY", ":0.0")
+        self._display = None
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def key(self, combo, repeat=1):
+        """Queue a key combination such as 'Page_Down' or 'ctrl+plus'"""
+        self._submit(("key", combo), repeat)
+
+    def scroll(self, button, repeat=1):
+        """Queue scroll wheel clicks, SCROLL_UP or SCROLL_DOWN"""
+        self._submit(("click", button), repeat)
+
+    @property
+    def pending(self):
+        """Number of queued events not sent yet"""
+        return self._queue.qsize()
+
+    def _submit(self, event, repeat):
+        """Add an event to the queue, starting the worker on first use"""
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(
+                    target=self._run, name="input-controller", daemon=True
+                )
+                self._worker.start()
+        self._queue.put((event, repeat))
+
+    def _run(self):
+        """Worker loop: drain the queue, coalesce repeats and send them"""
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            for event, repeat in coalesce(batch):
+                try:
+                    with metrics.span_seconds.time("input", event[0]):
+                        self._send(event, repeat)
+                except Exception as e:  # pylint: disable=broad-except
+                    logger.error("Could not send %s: %s", event, e)
+
+    def _connect(self):
+        """Return the X display connection, opening it if needed"""
+        if self._display is None and Display is not None:
+            try:
+                self._display = Display(self.display_name)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error("Could not open display %s: %s", self.display_name, e)
+        return self._display
+
+    def _send(self, event, repeat):
+        """Send one coalesced event through XTest, or xdotool as a fallback"""
+        display = self._connect()
+        if display is None:
+            xdotool(event, repeat)
+            return
+        try:
+            kind, value = event
+            if kind == "key":
+                keycodes = [keycode(display, name) for name in value.split("+")]
+                for _ in range(repeat):
+                    for code in keycodes:
+                        xtest.fake_input(display, X.KeyPress, code)
+                    for code in reversed(keycodes):
+                        xtest.fake_input(display, X.KeyRelease, code)
+            elif kind == "click":
+                x, y = POINTER_POSITION
+                xtest.fake_input(display, X.MotionNotify, x=x, y=y)
+                for _ in range(repeat):
+                    xtest.fake_input(display, X.ButtonPress, value)
+                    xtest.fake_input(display, X.ButtonRelease, value)
+            display.sync()
+        except Exception:
+            # Drop the connection so the next event reconnects
+            self._display = None
+            raise
+
+
+def coalesce(batch):
+    """Merge consecutive identical events, summing their repeat counts"""
+    merged = []
+    for event, repeat in batch:
+        if merged and merged[-1][0] == event:
+            merged[-1][1] += repeat
+        else:
+            merged.append([event, repeat])
+    return merged
+
+
+def keycode(display, name):
+    """Return the keycode of an xdotool-style key name"""
+    keysym = XK.string_to_keysym(MODIFIERS.get(name.lower(), name))
+    code = display.keysym_to_keycode(keysym)
+    if not code:
+        raise ValueError(f"Unknown key {name}")
+    return code
+
+
+def xdotool(event, repeat):
+    """Send an event by running xdotool once for all repeats"""
+    kind, value = event
+    if kind == "key":
+        args = ["key", "--repeat", str(repeat), value]
+    else:
+        x, y = POINTER_POSITION
+        args = ["mousemove", str(x), str(y), "click", "--repeat", str(repeat)]
+        args.append(str(value))
+    with metrics.span_seconds.time("subprocess", "xdotool"):
+        subprocess.run(["xdotool", *args], check=True)
+
+
+controller = InputController()
@@ -0,0 +1,147 @@
+""" Match recognized assistant text to an intent and its arguments. """
+
+SHOW_RECIPES = "show_recipes"
+OPEN_NUMBER = "open_number"
+OPEN_NAME = "open_name"
+SCROLL_UP = "scroll_up"
+SCROLL_DOWN = "scroll_down"
+TIMER = "timer"
+
+# Intents whose partial result cannot grow into a different intent
+EARLY_INTENTS = {SHOW_RECIPES, SCROLL_UP, SCROLL_DOWN}
+
+UNITS = {
+    word: i
+    for i, word in enumerate(
+        "zero one two three four five six seven eight nine ten eleven twelve "
+        "thirteen fourteen fifteen sixteen seventeen eighteen nineteen".split()
+    )
+}
+TENS = {
+    word: 10 * i
+    for i, word in enumerate(
+        "twenty thirty forty fifty sixty seventy eighty ninety".split(), start=2
+    )
+}
+SCALES = {"hundred": 100, "thousand": 1000}
+_UNIT_NAMES = {value: word for word, value in UNITS.items()}
+_TENS_NAMES = {value: word for word, value in TENS.items()}
+
+# Keyword sequences in priority order, matched as ordered subsequences of the
+# tokens. The slot names the argument parsed from the tokens after the match.
+PATTERNS = [
+    (("show", "recipes"), SHOW_RECIPES, None),
+    (("show", "recipe"), SHOW_RECIPES, None),
+    (("all", "recipes"), SHOW_RECIPES, None),
+    (("all", "recipe"), SHOW_RECIPES, None),
+    (("number",), OPEN_NUMBER, "number"),
+    (("open",), OPEN_NAME, "words"),
+    (("scroll", "up"), SCROLL_UP, None),
+    (("scroll", "down"), SCROLL_DOWN, None),
+    (("timer",), TIMER, "number"),
+]
+# Command words the speech grammar must contain
+KEYWORDS = sorted({word for keywords, _, _ in PATTERNS for word in keywords})
+# Patterns indexed by their first keyword, so one pass over the tokens finds
+# every candidate
+_BY_FIRST_WORD = {}
+for _priority, (_keywords, _intent, _slot) in enumerate(PATTERNS):
+    _BY_FIRST_WORD.setdefault(_keywords[0], []).append(
+        (_priority, _keywords, _intent, _slot)
+    )
+
+
+def match(text):
+    """
+    Return (intent, args) for the recognized text, or (None, ()) if no
+    command matches. Number slots that cannot be parsed also give (None, ()).
+    """
+    tokens = text.lower().split()
+    best = None
+    for start, token in enumerate(tokens):
+        for candidate in _BY_FIRST_WORD.get(token, ()):
+            if best is not None and candidate[0] >= best[0]:
+                continue
+            end = _match_rest(tokens, start + 1, candidate[1][1:])
+            if end is not None:
+                best = (candidate[0], candidate[2], candidate[3], end)
+    if best is None:
+        return None, ()
+
+    _, intent, slot, end = best
+    if slot == "number":
+        number = words_to_number(tokens[end:])
+        if number is None:
+            return None, ()
+        return intent, (number,)
+    if slot == "words":
+        words = tuple(word for word in tokens[end:] if word not in ("recipe", "the"))
+        return (intent, (words,)) if words else (None, ())
+    return intent, ()
+
+
+def _match_rest(tokens, start, keywords):
+    """Return the index after keywords found in order from start, or None"""
+    for keyword in keywords:
+        try:
+            start = tokens.index(keyword, start) + 1
+        except ValueError:
+            return None
+    return start
+
+
+def number_to_words(number):
+    """
+    Spell a number below a million with the words words_to_number parses,
+    e.g. 105 -> "one hundred and five". The speech grammar is built from it.
+    """
+    if number < 20:
+        return _UNIT_NAMES[number]
+    if number < 100:
+        tens, unit = divmod(number, 10)
+        return _TENS_NAMES[tens * 10] + (f" {_UNIT_NAMES[unit]}" if unit else "")
+    if number < 1000:
+        hundreds, rest = divmod(number, 100)
+        words = f"{_UNIT_NAMES[hundreds]} hundred"
+    else:
+        thousands, rest = divmod(number, 1000)
+        words = f"{number_to_words(thousands)} thousand"
+    if rest:
+        words += f"{' and' if rest < 100 else ''} {number_to_words(rest)}"
+    return words
+
+
+def words_to_number(tokens):
+    """
+    Parse the first run of number words, e.g. "one hundred and five" -> 105.
+    Returns None if the tokens contain no number.
+    """
+    total = current = 0
+    found = False
+    previous = None
+    for token in tokens:
+        if token in UNITS:
+            if previous == "unit":
+                break  # "two three" is two numbers, keep the first
+            current += UNITS[token]
+            previous = "unit"
+        elif token in TENS:
+            if previous in ("unit", "tens"):
+                break
+            current += TENS[token]
+            previous = "tens"
+        elif token == "hundred":
+            current = max(current, 1) * SCALES[token]
+            previous = "scale"
+        elif token == "thousand":
+            total += max(current, 1) * SCALES[token]
+            current = 0
+            previous = "scale"
+        elif token == "and" and found:
+            continue
+        elif found:
+            break
+        else:
+            continue
+        found = True
+    return total + current if found else None
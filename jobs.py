@@ -0,0 +1,186 @@
+""" Background jobs for the long-running kiosk commands: make, git pull and reset. """
+
+import os
+import sqlite3
+import subprocess
+import threading
+import time
+
+import metrics
+from shared_state import process_identity
+
+JOB_HISTORY = 20  # Finished jobs kept for the status endpoints
+JOB_OUTPUT_LINES = 200  # Output lines kept per job
+
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+INTERRUPTED = "interrupted"  # The process running the job exited, e.g. a restart
+
+
+class JobRunner:
+    """
+    Run one job at a time on a worker thread. Starting a job while another
+    one runs, in any worker process, is rejected, since make, git pull and
+    make clean all rewrite the same files. Job status and output live in the
+    shared state so every worker can report them.
+    """
+
+    def __init__(self, state, history=JOB_HISTORY):
+        self.state = state
+        self.history = history
+
+    def start(self, name, commands):
+        """
+        Start running commands (argument lists) in order, stopping at the
+        first failure.
+        Returns (job state, True), or (running job state, False) if busy.
+        """
+        conn = self.state.connection()
+        self._reap()
+        try:
+            with conn:
+                job_id = conn.execute(
+                    """
+                INSERT INTO jobs (name, status, pid, process, started)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                    (
+                        name,
+                        RUNNING,
+                        os.getpid(),
+                        process_identity(os.getpid()),
+                        time.time(),
+                    ),
+                ).lastrowid
+                # Drop the oldest jobs
+                conn.execute("DELETE FROM jobs WHERE id <= ?", (job_id - self.history,))
+                conn.execute(
+                    "DELETE FROM job_output WHERE job_id <= ?",
+                    (job_id - self.history,),
+                )
+        except sqlite3.IntegrityError:
+            running = conn.execute(
+                "SELECT id FROM jobs WHERE status = ?", (RUNNING,)
+            ).fetchone()
+            return self.get(running["id"]) if running else None, False
+        self.state.notify()
+        threading.Thread(
+            target=self._run,
+            args=(job_id, commands),
+            name=f"job-{name}",
+            daemon=True,
+        ).start()
+        return self.get(job_id), True
+
+    def get(self, job_id):
+        """Return the state of a job with its output tail, or None if unknown"""
+        self._reap()
+        conn = self.state.connection()
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        del job["pid"], job["process"]
+        job["output"] = [
+            text
+            for (text,) in conn.execute(
+                "SELECT text FROM job_output WHERE job_id = ? ORDER BY line",
+                (job_id,),
+            )
+        ]
+        return job
+
+    def list(self):
+        """Return the states of the recent jobs, newest first"""
+        conn = self.state.connection()
+        ids = conn.execute("SELECT id FROM jobs ORDER BY id DESC").fetchall()
+        return [self.get(job_id) for (job_id,) in ids]
+
+    def wait(self, job_id, version, timeout):
+        """
+        Wait up to timeout for the job to change after version.
+        Returns its state, or None if unknown.
+        """
+        conn = self.state.connection()
+
+        def changed():
+            row = conn.execute(
+                "SELECT version FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            return row is None or row[0] > version
+
+        self.state.wait_for(changed, timeout)
+        return self.get(job_id)
+
+    def _reap(self):
+        """Mark running jobs whose process is gone as interrupted"""
+        conn = self.state.connection()
+        for job_id, pid, process in conn.execute(
+            "SELECT id, pid, process FROM jobs WHERE status = ?", (RUNNING,)
+        ).fetchall():
+            if process_identity(pid) != process:
+                self._finish(job_id, INTERRUPTED, None)
+
+    def _output(self, job_id, line):
+        """Append an output line to a job, keeping the last JOB_OUTPUT_LINES"""
+        conn = self.state.connection()
+        with conn:
+            conn.execute(
+                "UPDATE jobs SET lines = lines + 1, version = version + 1 WHERE id = ?",
+                (job_id,),
+            )
+            conn.execute(
+                """
+            INSERT INTO job_output (job_id, line, text)
+            SELECT id, lines, ? FROM jobs WHERE id = ?
+            """,
+                (line, job_id),
+            )
+            conn.execute(
+                """
+            DELETE FROM job_output
+            WHERE job_id = ? AND line <= (SELECT lines FROM jobs WHERE id = ?) - ?
+            """,
+                (job_id, job_id, JOB_OUTPUT_LINES),
+            )
+        self.state.notify()
+
+    def _finish(self, job_id, status, returncode):
+        """Record the final status of a running job"""
+        conn = self.state.connection()
+        with conn:
+            conn.execute(
+                """
+            UPDATE jobs
+            SET status = ?, returncode = ?, finished = ?, version = version + 1
+            WHERE id = ? AND status = ?
+            """,
+                (status, returncode, time.time(), job_id, RUNNING),
+            )
+        self.state.notify()
+
+    def _run(self, job_id, commands):
+        """Worker: run the job's commands, capturing their output"""
+        returncode = 0
+        try:
+            for args in commands:
+                self._output(job_id, f"$ {' '.join(args)}")
+                with metrics.span_seconds.time("subprocess", args[0]):
+                    with subprocess.Popen(
+                        args,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT,
+                        text=True,
+                        errors="replace",
+                    ) as process:
+                        for line in process.stdout:
+                            self._output(job_id, line.rstrip("\n"))
+                        returncode = process.wait()
+                if returncode != 0:
+                    break
+        except OSError as e:
+            self._output(job_id, str(e))
+            returncode = -1
+        finally:
+            self._finish(job_id, SUCCEEDED if returncode == 0 else FAILED, returncode)
@@ -0,0 +1,249 @@
+""" In-process metrics in the Prometheus text format and a slow request profiler. """
+
+import bisect
+import collections
+import contextlib
+import os
+import re
+import sys
+import threading
+import time
+
+# Seconds, from a cached page hit to a full recipe build
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+MAX_PROFILES = 100  # Folded stack files kept by the slow request profiler
+
+
+class Metric:
+    """Base of the metric types: name, help text and label names"""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _labels(self, labels, extra=None):
+        """Format the label set of a sample, with an optional extra pair"""
+        pairs = list(zip(self.labelnames, labels))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        return "{%s}" % ",".join(f'{name}="{escape(value)}"' for name, value in pairs)
+
+    def render(self):
+        """Return the HELP, TYPE and sample lines of the metric"""
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        lines.extend(self.samples())
+        return lines
+
+    def samples(self):
+        """Return the sample lines of the metric"""
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """Monotonic counter per label set"""
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = collections.defaultdict(float)
+
+    def inc(self, *labels, amount=1):
+        """Add amount to the counter of a label set"""
+        with self._lock:
+            self._values[labels] += amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [
+            f"{self.name}{self._labels(labels)} {value:g}" for labels, value in values
+        ]
+
+
+class Gauge(Metric):
+    """Value read from a callback when the metrics are scraped"""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, callback):
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def samples(self):
+        return [f"{self.name} {self.callback():g}"]
+
+
+class Histogram(Metric):
+    """Cumulative histogram of observed values per label set"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value, *labels):
+        """Record one observation for a label set"""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        """Observe the duration of the with block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts)) for labels, counts in self._values.items()]
+        lines = []
+        for labels, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(
+                    f"{self.name}_bucket{self._labels(labels, ('le', le))} {cumulative}"
+                )
+            lines.append(f"{self.name}_sum{self._labels(labels)} {counts[-1]:.6f}")
+            lines.append(f"{self.name}_count{self._labels(labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Set of metrics rendered together for a scrape"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        """Add a metric and return it"""
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def escape(value):
+    """Escape a label value"""
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+class SlowRequestProfiler:
+    """
+    Sampling profiler for slow requests. While enabled, a thread samples the
+    stacks of the threads serving requests every interval. When a request
+    takes longer than the threshold its samples are written to directory in
+    the folded format read by flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, directory, threshold=0.5, interval=0.005):
+        self.directory = directory
+        self.threshold = threshold
+        self.interval = interval
+        self._active = {}  # thread id -> Counter of folded stacks
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start_request(self):
+        """Start sampling the calling thread"""
+        with self._lock:
+            self._active[threading.get_ident()] = collections.Counter()
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="slow-request-profiler", daemon=True
+                )
+                self._thread.start()
+
+    def finish_request(self, name, duration):
+        """Stop sampling the calling thread, writing its stacks if it was slow"""
+        with self._lock:
+            stacks = self._active.pop(threading.get_ident(), None)
+        if stacks and duration >= self.threshold:
+            self._write(name, duration, stacks)
+
+    def _run(self):
+        """Sampler loop"""
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()  # pylint: disable=protected-access
+            with self._lock:
+                for ident, stacks in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stacks[fold(frame)] += 1
+
+    def _write(self, name, duration, stacks):
+        """Write the folded stacks of a slow request, dropping the oldest files"""
+        os.makedirs(self.directory, exist_ok=True)
+        slug = re.sub(r"[^\w.-]+", "_", name).strip("_") or "request"
+        path = os.path.join(
+            self.directory,
+            f"{time.strftime('%Y%m%d-%H%M%S')}-{slug}-{duration * 1000:.0f}ms.folded",
+        )
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        profiles = sorted(
+            entry for entry in os.listdir(self.directory) if entry.endswith(".folded")
+        )
+        for entry in profiles[:-MAX_PROFILES]:
+            os.remove(os.path.join(self.directory, entry))
+
+
+def fold(frame):
+    """Return a stack as 'outer;...;inner' frames of 'file:function'"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+registry = Registry()
+request_seconds = registry.register(
+    Histogram(
+        "cookbook_request_seconds",
+        "Request latency by route, method and status",
+        ("route", "method", "status"),
+    )
+)
+span_seconds = registry.register(
+    Histogram(
+        "cookbook_span_seconds",
+        "Time spent in database queries, template rendering and subprocesses",
+        ("span", "name"),
+    )
+)
+cache_requests = registry.register(
+    Counter(
+        "cookbook_cache_requests_total",
+        "Cache lookups by cache and result",
+        ("cache", "result"),
+    )
+)
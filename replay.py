@@ -0,0 +1,242 @@
+""" Replay recorded WAV files through the assistant and benchmark its latency. """
+
+import argparse
+import json
+import os
+import time
+import wave
+
+import numpy as np
+
+import assistant
+import intents
+
+SILENCE_SECONDS = 1.0  # Silence inserted after every file to end its utterance
+
+
+class WavStream:
+    """Stand-in for the PyAudio input stream, reading WAV files back to back"""
+
+    def __init__(self, paths):
+        self.chunks = []
+        self.ranges = []  # (path, first sample, end sample) of every file
+        position = 0
+        for path in paths:
+            with wave.open(path, "rb") as wav:
+                if (
+                    wav.getframerate() != assistant.SAMPLE_RATE
+                    or wav.getnchannels() != 1
+                    or wav.getsampwidth() != 2
+                ):
+                    raise ValueError(f"{path}: expected 16 kHz mono 16-bit PCM")
+                pcm = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+            silence = np.zeros(int(SILENCE_SECONDS * assistant.SAMPLE_RATE), np.int16)
+            self.chunks.append(np.concatenate([pcm, silence]))
+            self.ranges.append((path, position, position + len(pcm)))
+            position += len(pcm) + len(silence)
+        self.audio = np.concatenate(self.chunks) if self.chunks else np.zeros(0)
+        self.position = 0
+
+    @property
+    def seconds(self):
+        """Duration of the replayed audio"""
+        return len(self.audio) / assistant.SAMPLE_RATE
+
+    def read(
+        self, frames, exception_on_overflow=False
+    ):  # pylint: disable=unused-argument
+        """Return the next frames samples as bytes, empty at the end"""
+        pcm = self.audio[self.position : self.position + frames]
+        self.position += len(pcm)
+        return pcm.astype(np.int16).tobytes()
+
+    def stop_stream(self):
+        """Nothing to stop"""
+
+    def close(self):
+        """Nothing to close"""
+
+
+class FileStartWake:
+    """Wake word stand-in that fires at the start of every file"""
+
+    frame_length = 512
+
+    def __init__(self, ranges, recorder):
+        self.starts = [start for _, start, _ in ranges]
+        self.recorder = recorder
+
+    def process(self, pcm):
+        """Detect a 'wake word' in the frame that contains a file start"""
+        end = self.recorder.cursor
+        return 0 if any(end - len(pcm) <= s < end for s in self.starts) else -1
+
+    def delete(self):
+        """Nothing to release"""
+
+
+class Recorder:
+    """Stub side effects and record wake and dispatch times in audio samples"""
+
+    def __init__(self):
+        self.porcupine = None
+        self.frame_length = None
+        self.cursor = 0  # Last cursor returned by the ring
+        self.wake = None
+        self.events = []  # (wake sample, dispatch sample, text, intent)
+
+    def process(self, pcm):
+        """Run the wake word engine and note where it fired"""
+        keyword_index = self.porcupine.process(pcm)
+        if keyword_index >= 0:
+            self.wake = self.cursor
+        return keyword_index
+
+    def delete(self):
+        """Release the wake word engine"""
+        self.porcupine.delete()
+
+    def read(self, cursor, frames, _read=None):
+        """Ring read that remembers the cursor"""
+        self.cursor, pcm = _read(cursor, frames)
+        return self.cursor, pcm
+
+    def parse(self, result, _parse=None):
+        """Record the recognized text and intent, then run the real parse"""
+        text = json.loads(result).get("text", "")
+        self.events.append((self.wake, self.cursor, text, intents.match(text)))
+        _parse(result)
+
+    def submit(self, action, *args):
+        """Side effects are dropped during replay"""
+
+    def shutdown(self, timeout=0):
+        """Nothing to flush"""
+
+    def key(self, combo, repeat=1):
+        """Key presses are dropped during replay"""
+
+    def scroll(self, button, repeat=1):
+        """Scroll clicks are dropped during replay"""
+
+
+def load_labels(path):
+    """Read 'file.wav<TAB>expected text' lines, several commands split by ' | '"""
+    labels = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip() and not line.startswith("#"):
+                name, text = line.rstrip("\n").split("\t", 1)
+                labels[os.path.basename(name)] = [
+                    " ".join(part.lower().split()) for part in text.split("|")
+                ]
+    return labels
+
+
+def percentile(values, q):
+    """Return the q-th percentile of values, None when empty"""
+    return float(np.percentile(values, q)) if values else None
+
+
+def replay(paths, labels=None, model_path=None, wake_file=None):
+    """
+    Feed WAV files through init's recognizer, loop, vosk_listen and parse,
+    with side effects stubbed, and return the benchmark report.
+    """
+    stream = WavStream(paths)
+    recorder = Recorder()
+    if wake_file:
+        recorder.porcupine = assistant.pvporcupine.create(
+            access_key=assistant.ACCESS_KEY, keyword_paths=[wake_file]
+        )
+    else:
+        recorder.porcupine = FileStartWake(stream.ranges, recorder)
+    recorder.frame_length = recorder.porcupine.frame_length
+    recognizer = assistant.create_recognizer(model_path or assistant.MODEL_PATH)
+    ring = assistant.AudioRing(
+        stream, max_read=max(assistant.VOSK_FRAMES, assistant.LOW_LATENCY_FRAMES)
+    )
+    read, parse = ring.read, assistant.parse
+    ring.read = lambda cursor, frames: recorder.read(cursor, frames, _read=read)
+    assistant.parse = lambda result: recorder.parse(result, _parse=parse)
+    assistant.actions = recorder
+    assistant.input_controller = recorder
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        assistant.loop(recorder, None, ring, recognizer)
+    finally:
+        assistant.parse = parse
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+    latencies = [
+        (dispatch - wake) / assistant.SAMPLE_RATE * 1000
+        for wake, dispatch, _, _ in recorder.events
+    ]
+    report = {
+        "files": len(paths),
+        "audio_seconds": round(stream.seconds, 3),
+        "commands": len(recorder.events),
+        "wake_to_intent_ms": {f"p{q}": percentile(latencies, q) for q in (50, 90, 99)},
+        "real_time_factor": wall / stream.seconds if stream.seconds else None,
+        "cpu_seconds_per_audio_second": (
+            cpu / stream.seconds if stream.seconds else None
+        ),
+    }
+
+    if labels:
+        texts, matched_texts, matched_intents, total = {}, 0, 0, 0
+        for wake, _, text, intent in recorder.events:
+            for path, start, end in stream.ranges:
+                if start <= wake < end + SILENCE_SECONDS * assistant.SAMPLE_RATE:
+                    texts.setdefault(os.path.basename(path), []).append((text, intent))
+        for path, _, _ in stream.ranges:
+            expected = labels.get(os.path.basename(path))
+            if expected is None:
+                continue
+            recognized = texts.get(os.path.basename(path), [])
+            total += len(expected)
+            for i, text in enumerate(expected):
+                if i < len(recognized):
+                    matched_texts += recognized[i][0] == text
+                    matched_intents += recognized[i][1] == intents.match(text)
+        report["labelled_commands"] = total
+        report["text_accuracy"] = matched_texts / total if total else None
+        report["intent_accuracy"] = matched_intents / total if total else None
+    return report
+
+
+def parse_args():
+    """Parse command line arguments and run the replay."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("wav", nargs="+", help="16 kHz mono 16-bit WAV files")
+    parser.add_argument("--labels", help="tab-separated file name and expected text")
+    parser.add_argument("--model", help="Vosk model directory")
+    parser.add_argument(
+        "--wake-file",
+        help="Porcupine keyword file for this platform; without it every file "
+        "is treated as starting right after the wake word",
+    )
+    parser.add_argument("--low-latency", action="store_true")
+    parser.add_argument("--frames", type=int, help="samples per Vosk read")
+    parser.add_argument("--silence-timeout", type=float)
+    args = parser.parse_args()
+
+    if args.low_latency:
+        assistant.LOW_LATENCY = True
+    if args.frames:
+        assistant.VOSK_FRAMES = assistant.LOW_LATENCY_FRAMES = args.frames
+    if args.silence_timeout:
+        assistant.SILENCE_TIMEOUT = args.silence_timeout
+
+    report = replay(
+        args.wav,
+        labels=load_labels(args.labels) if args.labels else None,
+        model_path=args.model,
+        wake_file=args.wake_file,
+    )
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parse_args()
@@ -0,0 +1,221 @@
+""" State shared by the web app's worker processes, kept in a local SQLite file. """
+
+import contextlib
+import os
+import socket
+import threading
+import time
+
+import database
+
+POLL_INTERVAL = (
+    0.05  # Seconds between checks for other processes' changes, without wakeups
+)
+WAKEUP_POLL_INTERVAL = 1.0  # Seconds between checks with wakeups, in case one was lost
+BOOT_ID_FILE = "/proc/sys/kernel/random/boot_id"
+
+
+class SharedState:
+    """
+    SQLite file holding the command queue and the background jobs, so every
+    worker process serves the same state. It is separate from recipes.db,
+    which make clean deletes. Each thread uses its own connection.
+
+    Each waiting process binds a datagram socket in the <path>-notify
+    directory, and a change wakes the others by sending to every socket there.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.notify_dir = f"{path}-notify"
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._ready = False
+        self._changed = threading.Condition()
+        self._changes = 0  # Bumped by every wakeup, so a waiter cannot miss one
+        self._listener_pid = None
+        self._listening = False
+        self._sender = None
+
+    def connection(self):
+        """Return the calling thread's connection, creating the schema on first use"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = database.connect(self.path)
+            with self._lock:
+                if not self._ready:
+                    create_schema(conn)
+                    self._ready = True
+        return conn
+
+    def notify(self):
+        """Wake up the threads of every process waiting for a change"""
+        self._wake()
+        try:
+            names = os.listdir(self.notify_dir)
+        except OSError:
+            return
+        own = str(os.getpid())
+        for name in names:
+            if name == own:
+                continue
+            address = os.path.join(self.notify_dir, name)
+            try:
+                self._socket().sendto(b"\0", address)
+            except BlockingIOError:
+                pass  # Its queue is full of wakeups already
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Left behind by a process that exited
+                with contextlib.suppress(OSError):
+                    os.unlink(address)
+            except OSError:
+                pass
+
+    def wait_for(self, check, timeout):
+        """
+        Call check until it returns a true value or timeout passes.
+        Returns the last value returned by check.
+        """
+        interval = WAKEUP_POLL_INTERVAL if self._listen() else POLL_INTERVAL
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._changed:
+                seen = self._changes
+            result = check()
+            remaining = deadline - time.monotonic()
+            if result or remaining <= 0:
+                return result
+            with self._changed:
+                if self._changes == seen:
+                    self._changed.wait(min(interval, remaining))
+
+    def _wake(self):
+        """Wake up the threads of this process waiting for a change"""
+        with self._changed:
+            self._changes += 1
+            self._changed.notify_all()
+
+    def _socket(self):
+        """Return the non-blocking socket sending the wakeups"""
+        if self._sender is None:
+            sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sender.setblocking(False)
+            self._sender = sender
+        return self._sender
+
+    def _listen(self):
+        """
+        Start receiving the other processes' wakeups, once per process.
+        Returns False if that is not possible, waiters then poll.
+        """
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return self._listening
+            self._listener_pid = os.getpid()
+            address = os.path.join(self.notify_dir, str(os.getpid()))
+            try:
+                os.makedirs(self.notify_dir, exist_ok=True)
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(address)  # Left behind by an earlier process with the pid
+                listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                listener.bind(address)
+            except OSError:
+                self._listening = False
+                return False
+            self._listening = True
+        threading.Thread(
+            target=self._receive, args=(listener,), name="state-wakeup", daemon=True
+        ).start()
+        return True
+
+    def _receive(self, listener):
+        """Listener thread: wake up this process' waiters for every datagram"""
+        while True:
+            try:
+                listener.recv(64)
+            except OSError:
+                time.sleep(POLL_INTERVAL)
+            self._wake()
+
+
+def create_schema(conn):
+    """Create the shared state tables"""
+    with conn:
+        conn.execute("BEGIN")
+        conn.execute(
+            """
+        CREATE TABLE IF NOT EXISTS commands (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            command TEXT NOT NULL
+        )
+        """
+        )
+        conn.execute(
+            """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            status TEXT NOT NULL,
+            returncode INTEGER,
+            pid INTEGER,
+            started REAL NOT NULL,
+            finished REAL,
+            lines INTEGER NOT NULL DEFAULT 0,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+        """
+        )
+        # Identity of the process running the job, added after the pid:
+        # a pid alone may have been reused by another process
+        columns = [row["name"] for row in conn.execute("PRAGMA table_info(jobs)")]
+        if "process" not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN process TEXT")
+        # At most one running job across all processes
+        conn.execute(
+            """
+        CREATE UNIQUE INDEX IF NOT EXISTS jobs_running ON jobs (status)
+        WHERE status = 'running'
+        """
+        )
+        conn.execute(
+            """
+        CREATE TABLE IF NOT EXISTS job_output (
+            job_id INTEGER NOT NULL,
+            line INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            PRIMARY KEY (job_id, line)
+        ) WITHOUT ROWID
+        """
+        )
+
+
+def process_alive(pid):
+    """Return whether a process with the pid exists"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def process_identity(pid):
+    """
+    Return a string identifying the process with the pid across pid reuse and
+    reboots: the boot id and the process start time, or the pid alone where
+    there is no /proc. Returns None if the process does not exist.
+    """
+    try:
+        with open(f"/proc/{pid}/stat", encoding="utf-8", errors="replace") as f:
+            stat = f.read()
+        with open(BOOT_ID_FILE, encoding="utf-8") as f:
+            boot_id = f.read().strip()
+    except FileNotFoundError:
+        if os.path.isdir("/proc"):
+            return None
+        return str(pid) if process_alive(pid) else None
+    # The fields after the command name, which may hold spaces and
+    # parentheses, start at field 3; the start time is field 22
+    start_time = stat[stat.rindex(")") + 2 :].split()[19]
+    return f"{boot_id}:{pid}:{start_time}"
@@ -26,24 +26,86 @@ function openLink() {
         });
 }
 
+// Start a background job and reload the page once it has finished
 function reload(path) {
-    fetch(path);
-    showAlert("Page reloading in 5 seconds");
-    // Update time to reload every second, make sure plural is used correctly do not show 0 seconds
-    let seconds = 5;
-    const interval = setInterval(() => {
-        seconds--;
-        if (seconds === 1) {
-            document.getElementById("alert-message").textContent = "Page reloading in 1 second";
-        } else if (seconds === 0) {
-            clearInterval(interval);
-        } else {
-            document.getElementById("alert-message").textContent = "Page reloading in " + seconds + " seconds";
+    showAlert("Starting " + path);
+    fetch(path)
+        .then(response => response.json())
+        .then(data => {
+            // 409 when another job is still running, follow that one instead
+            followJob(data.job || data);
+        })
+        .catch(error => {
+            showAlert("Could not start " + path + ": " + error);
+        });
+}
+
+function followJob(job) {
+    const events = new EventSource('/jobs/' + job.id + '/stream');
+    events.addEventListener('output', event => {
+        document.getElementById("alert-message").textContent = JSON.parse(event.data);
+    });
+    events.addEventListener('status', event => {
+        const status = JSON.parse(event.data);
+        if (status.status !== 'running') {
+            events.close();
+            finishJob(status);
         }
+    });
+    events.onerror = () => {
+        // The server went away, e.g. restarted by git_pull
+        events.close();
+        waitForServer(job);
+    };
+}
+
+function finishJob(job) {
+    if (job.status === 'succeeded' && job.name === 'git_pull') {
+        // The service restarts shortly after the pull: reload from the new one
+        waitForRestart(job, Date.now(), false);
+    } else if (job.status === 'succeeded' || job.status === 'interrupted') {
+        window.location.reload();
+    } else {
+        showAlert(job.name + " failed with exit code " + job.returncode);
+    }
+}
+
+// Poll until the server answers again; a restart marks the job interrupted
+function waitForServer(job) {
+    setTimeout(() => {
+        fetch('/jobs/' + job.id)
+            .then(response => {
+                if (response.status === 404) {
+                    window.location.reload();
+                } else if (response.ok) {
+                    response.json().then(status => {
+                        if (status.status === 'running') {
+                            followJob(status);
+                        } else {
+                            finishJob(status);
+                        }
+                    });
+                } else {
+                    waitForServer(job);
+                }
+            })
+            .catch(() => waitForServer(job));
     }, 1000);
+}
+
+// Poll until the server has gone away and answers again, or give up waiting
+function waitForRestart(job, since, down) {
     setTimeout(() => {
-        window.location.reload();
-    }, 5000);
+        fetch('/jobs/' + job.id)
+            .then(response => {
+                if ((down && response.ok) || Date.now() - since > 15000) {
+                    window.location.reload();
+                } else {
+                    waitForRestart(job, since, down || !response.ok);
+                }
+            })
+            .catch(() => waitForRestart(job, since, true));
+    }, 250);
 }
 
 function handleEnterKey(event) {
@@ -67,26 +129,10 @@ function searchRecipes() {
         tags[i].classList.add('is-primary');
     }
 
-    // Get the form element
-    const form = document.getElementById('searchForm');
-
-    // Perform a POST request with the form data
-    fetch('/find', {
-        method: 'POST',
-        body: new FormData(form), // Send form data
-    })
-    .then(response => response.text()) // Parse the response as text (HTML or JSON)
-    .then(data => {
-        // You can update the DOM with the response data here
-        document.getElementById('recipes').innerHTML = data;
-
-    })
-    .catch(error => {
-        console.error('Error:', error);
-    });
+    loadRecipes({ q: document.getElementById('search').value.trim() });
 }
 
-// flutag as args to /find
+// flutag as filter to /api/recipes
 function filterRecipes(tagElement, tag) {
     if (tagElement.classList.contains('is-selected')) {
         tagElement.classList.remove('is-selected');
@@ -105,25 +151,86 @@ function filterRecipes(tagElement, tag) {
     // Remove search text
     document.getElementById('search').value = '';
 
-    // Get the form element
-    const form = document.getElementById('searchForm');
+    loadRecipes({ tag: tag });
+}
 
-    // Perform a POST request with the form data
-    fetch('/find?tag=' + tag, {
-        method: 'POST',
-        body: new FormData(form), // Send form data
-    })
-    .then(response => response.text()) // Parse the response as text (HTML or JSON)
-    .then(data => {
-        // You can update the DOM with the response data here
-        document.getElementById('recipes').innerHTML = data;
+// Recipe listing, loaded a page at a time from /api/recipes
+const RECIPES_PAGE_SIZE = 24;
+let recipeFilter = {};
+let recipeCursor = document.getElementById('recipes').dataset.next || null;
+let recipeRequest = null; // AbortController of the page request in flight
+
+// Start a new listing for the filter, replacing the shown recipes
+function loadRecipes(filter) {
+    recipeFilter = filter;
+    recipeCursor = null;
+    if (recipeRequest) {
+        recipeRequest.abort(); // Drop the results of the previous keystroke
+    }
+    document.getElementById('recipes').replaceChildren();
+    fetchRecipes(null);
+}
+
+// Append the next page of the current listing, if any
+function loadMoreRecipes() {
+    if (recipeCursor && !recipeRequest) {
+        fetchRecipes(recipeCursor);
+    }
+}
+
+function fetchRecipes(after) {
+    const params = new URLSearchParams({ limit: RECIPES_PAGE_SIZE });
+    if (recipeFilter.q) {
+        params.set('q', recipeFilter.q);
+    }
+    if (recipeFilter.tag) {
+        params.set('tag', recipeFilter.tag);
+    }
+    if (after) {
+        params.set('after', after);
+    }
 
+    const controller = new AbortController();
+    recipeRequest = controller;
+    fetch('/api/recipes?' + params, { signal: controller.signal })
+    .then(response => response.json())
+    .then(data => {
+        appendRecipes(data.html);
+        recipeCursor = data.next;
     })
     .catch(error => {
-        console.error('Error:', error);
+        if (error.name !== 'AbortError') {
+            console.error('Error:', error);
+        }
+    })
+    .finally(() => {
+        if (recipeRequest === controller) {
+            recipeRequest = null;
+            fillRecipes();
+        }
     });
 }
 
+// Add the cards rendered by the server in one DOM update
+function appendRecipes(html) {
+    document.getElementById('recipes').insertAdjacentHTML('beforeend', html);
+}
+
+// Keep loading while the end of the list is on screen, the observer only
+// fires when it scrolls into view
+function fillRecipes() {
+    const more = document.getElementById('recipes-more');
+    if (more.getBoundingClientRect().top < window.innerHeight + 600) {
+        loadMoreRecipes();
+    }
+}
+
+new IntersectionObserver(entries => {
+    if (entries[0].isIntersecting) {
+        loadMoreRecipes();
+    }
+}, { rootMargin: '600px' }).observe(document.getElementById('recipes-more'));
+
 function showAlert(message) {
     const alertOverlay = document.getElementById("alert-overlay");
     const alertMessage = document.getElementById("alert-message");
@@ -1,20 +1,19 @@
 let activeTimer = null; // Reference to the active timer interval
 let timerEndTime = null; // Track the end time of the current timer
 
-async function pollCommands() {
-    while (true) {
-        const response = await fetch('/commands');
-        const data = await response.json();
-
-        if (data && data.action === 'timer') {
-            const duration = data.duration * 60; // Convert minutes to seconds
-            startNewTimer(duration);
-        }
-
-        await new Promise(r => setTimeout(r, 1000));
+function handleCommand(data) {
+    if (data && data.action === 'timer') {
+        const duration = data.duration * 60; // Convert minutes to seconds
+        startNewTimer(duration);
     }
 }
 
+function listenCommands() {
+    // Commands are pushed by the server, EventSource reconnects on its own
+    const source = new EventSource('/commands/stream');
+    source.onmessage = (event) => handleCommand(JSON.parse(event.data));
+}
+
 function startNewTimer(duration) {
     // Cancel any existing timer
     if (activeTimer) {
@@ -53,4 +52,4 @@ function startNewTimer(duration) {
     }, 1000);
 }
 
-pollCommands();
+listenCommands();